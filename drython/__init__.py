@@ -1 +1,3 @@
 """ init """
+
+__version__ = '0.1'
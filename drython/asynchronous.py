@@ -0,0 +1,205 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+asyncio evaluation of S-expressions.
+
+s_eval_async evaluates like s_eval_in_scope, but as a coroutine, so
+a tree can wait on I/O without blocking the event loop.
+>>> import asyncio
+>>> from operator import add
+>>> from drython.s_expression import S
+>>> async def fetch(x):
+...     await asyncio.sleep(0.1)
+...     return x
+>>> loop = asyncio.new_event_loop()
+>>> loop.run_until_complete(s_eval_async(S(add, S(fetch, S.x), S(fetch, 2)), dict(x=40)))
+42
+>>> loop.close()
+
+This module needs Python 3.5 or later. The rest of drython doesn't.
+"""
+
+# asynchronous depends on statement, expression, s_expression, and macro.
+
+from __future__ import absolute_import, division
+import asyncio
+from inspect import isawaitable
+
+from drython.statement import do
+from drython.expression import entuple
+from drython.s_expression import S, SExpression, Symbol, Quote, s_evaluable, s_eval_in_scope
+from drython.macro import Scope, SEval, SSetQ, SIf, SLambda, SLambda0, SLambda1, SLambda2
+from drython.macro import SLambdaA, _unbound
+
+
+async def s_eval_async(element, scope):
+    """
+    Evaluates the element in the scope. Any S-expression argument or
+    head that evaluates to an awaitable is awaited, so async heads can
+    be used like any other. S-expression arguments are evaluated
+    concurrently, with asyncio.gather, so they could finish in any order.
+    >>> import asyncio
+    >>> from drython.s_expression import S
+    >>> from drython.expression import entuple
+    >>> log = []
+    >>> async def slow(x):
+    ...     log.append(('start', x))
+    ...     await asyncio.sleep(0)
+    ...     log.append(('end', x))
+    ...     return x
+    >>> loop = asyncio.new_event_loop()
+    >>> loop.run_until_complete(s_eval_async(S(entuple, S(slow, 1), S(slow, 2), 3), {}))
+    (1, 2, 3)
+    >>> sorted(log[:2]), sorted(log[2:])  # both start before either ends.
+    ([('start', 1), ('start', 2)], [('end', 1), ('end', 2)])
+
+    Macros expand as they always do, before evaluation, and If only
+    evaluates the branch it takes. do evaluates its arguments in order,
+    and setq awaits each value before binding it, so let_n can bind
+    what an async head returns. Lambdas evaluate to functions that
+    return a coroutine evaluating their body, which the S-expression
+    calling them awaits. Other SEvaluables evaluate with their own s_eval.
+    >>> from drython.macro import let_n
+    >>> loop = asyncio.new_event_loop()
+    >>> loop.run_until_complete(s_eval_async(
+    ...     S(let_n, (S.a, S(slow, 1), S.b, S(slow, S.a)), S(entuple, S.a, S.b)), {}))
+    (1, 1)
+
+    Errors have the same context s_eval would add.
+    >>> loop.run_until_complete(s_eval_async(S(entuple, S(slow, S.x)), {}))  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    drython.s_expression.SExpressionException: when evaluating
+    S(<function entuple at ...>,
+      S(<function slow at ...>,
+        S.x))
+    >>> loop.close()
+    """
+    if not s_evaluable(element):
+        return element
+    evaluate = _async_evals.get(type(element))
+    if evaluate is not None:
+        return await evaluate(element, scope)
+    if type(element) is not SExpression or not element:
+        return await _awaited(s_eval_in_scope(element, scope))
+    try:
+        func = await s_eval_async(element.args[0], scope)
+        if hasattr(func, '_macro_'):
+            return await s_eval_async(element.expansion(func), scope)
+        if func is do:
+            values = []
+            for e in element.args[1:]:
+                values.append(await s_eval_async(e, scope))
+            return do(*values)
+        values = await _s_eval_all_async(
+            element.args[1:] + tuple(element.kwargs.values()), scope)
+        nargs = len(element.args) - 1
+        return await _awaited(func(*values[:nargs], **dict(zip(element.kwargs, values[nargs:]))))
+    except asyncio.CancelledError:
+        raise  # not an error of this element's.
+    except BaseException as be:
+        element._s_raise(be)
+
+
+async def _awaited(value):
+    if isawaitable(value):
+        return await value
+    return value
+
+
+async def _s_eval_all_async(elements, scope):
+    values = []
+    pending = {}  # index: awaitable
+    for i, e in enumerate(elements):
+        if type(e) in (Symbol, Quote) or not s_evaluable(e):
+            value = s_eval_in_scope(e, scope)  # quicker than a task.
+            if isawaitable(value):
+                pending[i] = value
+            values.append(value)
+        else:
+            pending[i] = s_eval_async(e, scope)
+            values.append(None)
+    if len(pending) == 1:
+        (i, awaitable), = pending.items()
+        values[i] = await awaitable
+    elif pending:
+        for i, v in zip(pending, await asyncio.gather(*pending.values())):
+            values[i] = v
+    return values
+
+
+async def _if(element, scope):
+    if await s_eval_async(element.boolean, scope):
+        return await s_eval_async(element.then, scope)
+    return await s_eval_async(element.Else, scope)
+
+
+async def _setq(element, scope):
+    for k, v in element.pairs:
+        scope[k] = await s_eval_async(v, scope)
+
+
+async def _eval(element, scope):
+    return await s_eval_async(await s_eval_async(element.body, scope), scope)
+
+
+async def _lambda(element, scope):
+    keys = element.keys
+    defaults = await s_eval_async(S(entuple, *element.defaults), scope)
+    body = element.block
+
+    # noinspection PyPep8Naming
+    def Lambda(local):
+        bindings = dict(zip(keys, defaults))
+        for k, v in local.items():
+            if v is not _unbound:
+                bindings[k] = v
+        return s_eval_async(body, Scope(scope, bindings))
+
+    return element._function(Lambda)
+
+
+async def _lambda0(element, scope):
+    def l0():
+        return s_eval_async(element.body, Scope(scope))
+
+    return l0
+
+
+async def _lambda1(element, scope):
+    def l1(arg):
+        return s_eval_async(element.body, Scope(scope, {element.symbol: arg}))
+
+    return l1
+
+
+async def _lambda2(element, scope):
+    def l2(x, y):
+        return s_eval_async(element.body, Scope(scope, {element.x: x, element.y: y}))
+
+    return l2
+
+
+async def _lambda_a(element, scope):
+    def la(*args):
+        return s_eval_async(element.body, Scope(scope, {element.args: args}))
+
+    return la
+
+
+# SEvaluables with an async evaluation of their own, by type.
+_async_evals = {SIf: _if, SSetQ: _setq, SEval: _eval, SLambda: _lambda,
+                SLambda0: _lambda0, SLambda1: _lambda1, SLambda2: _lambda2,
+                SLambdaA: _lambda_a}
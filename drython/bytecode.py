@@ -0,0 +1,290 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Python bytecode backend for S-expressions.
+
+pycompile() translates an S-expression into Python source, and
+compiles that with Python's own compiler, so the interpreter runs the
+whole call tree directly.
+>>> from operator import add, mul
+>>> from drython.s_expression import S
+>>> spam = pycompile(S(add,S(mul,S.x,10),2))
+>>> spam(dict(x=4))
+42
+
+Structurally identical trees share one compiled function, even when
+they're built separately.
+>>> pycompile(S(add,S(mul,S.x,10),2)) is spam
+True
+
+A lambda whose body needs nothing the generated code can't do itself
+becomes a Python lambda, so its parameters are plain Python locals.
+>>> from drython.macro import L1, If
+>>> print(pysource(S(L1, S.a, S(If, S.a, S(mul, S.a, S.x), 0))))
+def _make(_k):
+    _k0, _k1, _k2, _k3 = _k
+    def program(scope):
+        try:
+            return (lambda _v0: _k0((_k1(_v0, (scope['x'] if 'x' in scope else _k2.s_eval(scope))) if _v0 else 0)))
+        except BaseException as be:
+            _k3(be)
+    return program
+<BLANKLINE>
+
+Anything else is compiled with drython.s_expression.compile,
+and called from the generated code.
+
+The generated code is one Python expression, with no try for each
+node, so an error's context is only the whole tree, rather than the
+chain down to the failing node that s_eval and compile give. (Parts
+compiled with compile still give theirs.)
+>>> from operator import truediv
+>>> from drython.s_expression import SExpressionException
+>>> try:
+...     pycompile(S(add, 1, S(truediv, 1, S.x)))(dict(x=0))
+... except SExpressionException as se:
+...     print(se)
+...     print(type(se.__cause__).__name__)
+when evaluating
+S(<built-in function add>,
+  1,
+  S(<built-in function truediv>,
+    1,
+    S.x))
+ZeroDivisionError
+"""
+
+# bytecode depends on core, statement, s_expression, and macro.
+
+from __future__ import absolute_import, division
+from keyword import iskeyword
+import re
+import weakref
+
+from drython.s_expression import SExpression, SExpressionException, Symbol, Quote, _Evaluating
+from drython.s_expression import s_evaluable, parallel_args
+from drython.s_expression import compile as _compile
+from drython.macro import SIf, SLambda0, SLambda1, SLambda2, SLambdaA
+from drython.statement import Raise, LabeledBreak
+
+# deep nesting would overflow the Python parser, so deeper subtrees are
+# compiled separately, and called from the generated code.
+MAX_NESTING = 40
+
+_identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+_atomic = frozenset([int, str, bytes, bool, type(None)])
+_by_repr = frozenset([float, complex])
+_literal = frozenset([int, str, bool, type(None)])  # repr round-trips
+
+_cache = weakref.WeakValueDictionary()
+
+
+class _Opaque(Exception):
+    """raised for code that would need a Scope inside a generated lambda."""
+
+
+def structural_key(element):
+    """
+    A hashable key, equal for structurally identical elements.
+
+    Atoms compare by value (and type), anything else by identity.
+    >>> from operator import add
+    >>> from drython.s_expression import S
+    >>> structural_key(S(add, S.x, 1)) == structural_key(S(add, S.x, 1))
+    True
+    >>> structural_key(S(add, S.x, 1)) == structural_key(S(add, S.x, 1.0))
+    False
+
+    The key is flat, the tree in prefix order, and is built with a
+    stack, so a deep tree neither recurses nor makes a deep key.
+    >>> spam = 0
+    >>> for _ in range(20000):
+    ...     spam = S(add, spam, 1)
+    >>> structural_key(spam) == structural_key(spam)
+    True
+    """
+    key = []
+    stack = [element]
+    while stack:
+        element = stack.pop()
+        kind = type(element)
+        if kind is SExpression:
+            key += SExpression, len(element.args), tuple(element.kwargs)
+            stack.extend(reversed(tuple(element.kwargs.values())))
+            stack.extend(reversed(element.args))
+        elif kind is Quote:
+            key.append(Quote)
+            stack.append(element.item)
+        elif kind is Symbol:
+            key += Symbol, str(element)
+        elif kind in _atomic:
+            key += kind, element
+        elif kind in _by_repr:
+            key += kind, repr(element)
+        else:
+            key += id, id(element)
+    return tuple(key)
+
+
+def pycompile(element):
+    """
+    Compiles the element into a function of a scope, using Python's
+    compiler. Like drython.s_expression.compile, but the result is one
+    generated function rather than a closure per node.
+
+    Compiled functions are cached by structural_key(element) for as
+    long as they're in use.
+    """
+    key = structural_key(element)
+    try:
+        return _cache[key]
+    except KeyError:
+        program = _cache[key] = _Generator().program(element)
+        return program
+
+
+def pysource(element):
+    """returns the Python source pycompile would generate for the element."""
+    return _Generator().source(element)[0]
+
+
+class _Generator(object):
+    def __init__(self):
+        self.constants = []
+        self.locals = 0
+
+    def constant(self, value):
+        self.constants.append(value)
+        return '_k%d' % (len(self.constants) - 1)
+
+    def source(self, element):
+        expr = self.expr(element, {}, 0)
+        top = self.constant(_raiser(element))
+        return (
+            'def _make(_k):\n'
+            '    {0} = _k\n'
+            '    def program(scope):\n'
+            '        try:\n'
+            '            return {1}\n'
+            '        except BaseException as be:\n'
+            '            {2}(be)\n'
+            '    return program\n'
+        ).format(', '.join(map('_k{0}'.format, range(len(self.constants))))
+                 + (',' if len(self.constants) == 1 else ''),
+                 expr, top), self.constants
+
+    def program(self, element):
+        source, constants = self.source(element)
+        namespace = {}
+        exec(compile(source, '<drython.bytecode>', 'exec'), namespace)
+        return namespace['_make'](constants)
+
+    def expr(self, element, env, nesting):
+        """
+        returns source for the element, with Symbols bound by enclosing
+        generated lambdas mapped to Python locals through env.
+        """
+        if nesting > MAX_NESTING:
+            return self.closure(element, env)
+        nesting += 1
+        if not s_evaluable(element):
+            if type(element) in _literal:
+                return repr(element)
+            return self.constant(element)
+        if type(element) is Symbol:
+            if element in env:
+                return env[element]
+            return "(scope[{0!r}] if {0!r} in scope else {1}.s_eval(scope))".format(
+                str(element), self.constant(element))
+        if type(element) is Quote:
+            return self.constant(element.item)
+        if type(element) is SIf:
+            return '({1} if {0} else {2})'.format(
+                *(self.expr(e, env, nesting) for e in (element.boolean, element.then, element.Else)))
+        if type(element) in (SLambda0, SLambda1, SLambda2, SLambdaA):
+            return self.lambda_(element, env, nesting)
+        if type(element) is SExpression and not element:
+            return self.constant(element)
+        if type(element) is SExpression and element.args:
+            head = element.args[0]
+            if not s_evaluable(head):
+                if hasattr(head, '_macro_') and hasattr(head, '_nocache_'):
+                    return self.closure(element, env)
+                if hasattr(head, '_macro_'):
+                    try:
+                        expansion = element.expansion(head)
+                    except BaseException:
+                        return self.closure(element, env)
+                    return self.expr(expansion, env, nesting)
+                if head in parallel_args:
+                    return self.closure(element, env)
+                return self.call(head, element, env, nesting)
+        return self.closure(element, env)
+
+    def call(self, head, element, env, nesting):
+        func = self.constant(head)
+        args = [self.expr(a, env, nesting) for a in element.args[1:]]
+        kwargs = {}
+        for k, v in element.kwargs.items():
+            if isinstance(k, str) and _identifier.match(k) and not iskeyword(k):
+                args.append('{0}={1}'.format(k, self.expr(v, env, nesting)))
+            else:
+                kwargs[self.constant(k)] = self.expr(v, env, nesting)
+        if kwargs:
+            args.append('**{%s}' % ', '.join(map('{0[0]}: {0[1]}'.format, kwargs.items())))
+        return '{0}({1})'.format(func, ', '.join(args))
+
+    def lambda_(self, element, env, nesting):
+        if type(element) is SLambda0:
+            params = ()
+        elif type(element) is SLambda1:
+            params = element.symbol,
+        elif type(element) is SLambda2:
+            params = element.x, element.y
+        else:
+            params = element.args,
+        names = ['_v%d' % (self.locals + i) for i in range(len(params))]
+        self.locals += len(params)
+        inner = dict(env)
+        inner.update(zip(map(str, params), names))
+        try:
+            body = self.expr(element.body, inner, nesting)
+        except _Opaque:
+            if env:
+                raise
+            return self.closure(element, env)
+        if type(element) is SLambdaA:
+            names[0] = '*' + names[0]
+        return '(lambda {0}: {1})'.format(', '.join(names), body)
+
+    def closure(self, element, env):
+        if env:
+            # The closure would need the enclosing lambda's bindings.
+            raise _Opaque
+        return '{0}(scope)'.format(self.constant(_compile(element)))
+
+
+def _raiser(element):
+    # the same context s_eval adds to any exception, for the whole tree,
+    # unless a closure for the whole tree has already added it.
+    def raiser(be):
+        if isinstance(be, LabeledBreak):
+            raise  # control flow, not an error.
+        if (isinstance(be, SExpressionException) and be.args
+                and type(be.args[0]) is _Evaluating and be.args[0].element is element):
+            raise
+        Raise(SExpressionException(_Evaluating(element)), From=be)
+
+    return raiser
@@ -0,0 +1,183 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An on-disk cache of macro-expanded S-expression programs, like
+__pycache__ is for Python modules.
+
+A process that finds a program in the cache loads its expansion, in
+drython.serialize's format, rather than expanding its macros again.
+>>> import tempfile
+>>> from operator import add
+>>> from drython.s_expression import S
+>>> from drython.macro import If
+>>> cache = ProgramCache(tempfile.mkdtemp())
+>>> spam = S(If, S.x, S(add, S.x, 1), 0)
+>>> cache.compile(spam)(dict(x=41))
+42
+>>> cache.compile(spam)(dict(x=0))
+0
+>>> cache.hits, cache.misses
+(1, 1)
+"""
+
+# cache depends on core, s_expression, macro, and serialize.
+
+from __future__ import absolute_import, division
+from contextlib import closing
+from hashlib import sha256
+from io import BytesIO
+import mmap
+import os
+import sys
+import tempfile
+
+from drython import __version__
+from drython.core import Empty
+from drython.s_expression import compile
+from drython.macro import macroexpand_all
+from drython.serialize import Dumper, dumps, load_buffer, VERSION
+
+
+class ProgramCache(object):
+    """
+    Macro-expanded programs, in files in the directory, named by a hash
+    of the program, the macros the scope binds, and the drython version.
+    Macros serialize by name, so the hash also covers each macro's code,
+    and the size and modification time of its module's file, which has
+    any helpers it calls, so a macro edited under the same name misses,
+    rather than loading its old expansions. A macro that calls helpers from some
+    other module can still go stale when only those helpers change.
+
+    Programs with anything that can't be serialized (see
+    help(drython.serialize)), are expanded every time, and counted in
+    uncached as well as misses. Files are written whole, then renamed,
+    so processes can share a cache. A hit still builds the expanded tree
+    from its file, but it doesn't expand any macros.
+
+    Hashing a program means serializing it, which takes about a third
+    as long as loading its expansion. If something cheaper identifies
+    it, like the source it was read from, pass that as the key instead.
+    Then only the macros the key and scope name are fingerprinted, so
+    the key should change with the macros the program uses.
+    >>> import tempfile
+    >>> from drython.s_expression import S
+    >>> cache = ProgramCache(tempfile.mkdtemp())
+    >>> source = "S(abs, S.x)"
+    >>> cache.compile(eval(source), key=source)(dict(x=-3))
+    3
+    >>> cache.compile(eval(source), key=source)(dict(x=-4)), cache.hits
+    (4, 1)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = self.misses = self.uncached = 0
+
+    def path(self, element, scope=Empty, key=None):
+        """
+        returns the path of the file element's expansion in scope is
+        cached in, or None if it can't be.
+        """
+        macros = tuple(sorted((k, v) for k, v in scope.items() if hasattr(v, '_macro_')))
+        file = BytesIO()
+        dumper = Dumper(file)
+        try:
+            dumper.dump((__version__, VERSION, macros, element if key is None else key))
+        except TypeError:
+            return None
+        # every macro named in the stream, from the scope or the tree.
+        dumper.dump(tuple(_fingerprint(x) for x in dumper.table
+                          if callable(x) and hasattr(x, '_macro_')))
+        return os.path.join(self.directory, sha256(file.getvalue()).hexdigest() + '.drs')
+
+    def expanded(self, element, scope=Empty, key=None):
+        """
+        returns macroexpand_all(element, scope), from the cache if there,
+        else expanding it, and caching it for next time.
+        """
+        path = self.path(element, scope, key)
+        if path is not None:
+            try:
+                expanded = _load_mapped(path)
+            except (EnvironmentError, ValueError, EOFError, IndexError):
+                pass  # missing, or not whole. Either way, make it again.
+            else:
+                self.hits += 1
+                return expanded
+        self.misses += 1
+        expanded = macroexpand_all(element, scope)
+        data = None
+        if path is not None:
+            try:
+                data = dumps(expanded)
+            except TypeError:
+                pass  # a macro put in something unserializable.
+        if data is None:
+            self.uncached += 1
+        else:
+            self._save(path, data)
+        return expanded
+
+    def compile(self, element, scope=Empty, key=None):
+        """
+        returns compile() of the element's expansion, from the cache.
+        see help(drython.s_expression.compile)
+        """
+        return compile(self.expanded(element, scope, key))
+
+    def _save(self, path, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        getattr(os, 'replace', os.rename)(temp, path)
+
+
+def _fingerprint(macro):
+    # what the macro's expansions depend on, besides its name: its code,
+    # and its module's file.
+    digest = sha256()
+    codes = [getattr(macro, '__code__', None)]
+    while codes:
+        code = codes.pop()
+        if code is None:
+            continue
+        digest.update(code.co_code)
+        digest.update(' '.join(code.co_names).encode('utf-8'))
+        for constant in code.co_consts:
+            if hasattr(constant, 'co_code'):
+                codes.append(constant)  # a nested function's, or lambda's.
+            elif isinstance(constant, frozenset):
+                # in the same order each run, whatever the hash seed.
+                digest.update(repr(sorted(map(repr, constant))).encode('utf-8'))
+            else:
+                digest.update(repr(constant).encode('utf-8'))
+    module = sys.modules.get(getattr(macro, '__module__', None))
+    try:
+        stat = os.stat(module.__file__)
+    except (AttributeError, TypeError, EnvironmentError):
+        pass  # not from a file.
+    else:
+        digest.update(repr((stat.st_mtime, stat.st_size)).encode('utf-8'))
+    return digest.digest()
+
+
+def _load_mapped(path):
+    # Mapping the file only saves reading it into a copy first. The
+    # tree is built from it all the same.
+    with open(path, 'rb') as file:
+        with closing(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+            return load_buffer(mapped)
@@ -0,0 +1,120 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Columnar evaluation of S-expressions over NumPy arrays.
+
+When a scope binds Symbols to arrays (the columns of a table), a tree
+evaluated with s_eval_columnar makes one vectorized call per node,
+rather than one Python call per node per row.
+>>> import numpy as np
+>>> from operator import add, mul, gt
+>>> from drython.s_expression import S
+>>> from drython.macro import If
+>>> rule = S(If, S(gt, S.price, 2), S(mul, S.price, S.qty), S(add, S.qty, 100))
+>>> s_eval_columnar(rule, dict(price=np.array([1, 2, 3]), qty=np.array([4, 5, 6])))
+array([104, 105,  18])
+
+This module needs NumPy. The rest of drython doesn't.
+"""
+
+# columnar depends on numpy, core, s_expression, and macro.
+
+from __future__ import absolute_import, division
+import operator
+
+import numpy as np
+
+from drython.s_expression import SExpression, Symbol, Quote, s_evaluable, s_eval_in_scope
+from drython.macro import SIf, cond
+
+
+class ColumnarError(TypeError):
+    """raised for code with no vectorized equivalent."""
+
+
+# Heads s_eval_columnar knows how to vectorize, and what to call instead.
+# Add to it for others, e.g. vectorized[f] = np.vectorize(f) to run f
+# row by row, knowingly.
+vectorized = {getattr(operator, k): v for k, v in (
+    ('abs', np.absolute), ('add', np.add), ('and_', np.bitwise_and),
+    ('div', np.divide), ('eq', np.equal), ('floordiv', np.floor_divide),
+    ('ge', np.greater_equal), ('gt', np.greater), ('inv', np.invert),
+    ('invert', np.invert), ('le', np.less_equal), ('lshift', np.left_shift),
+    ('lt', np.less), ('mod', np.mod), ('mul', np.multiply), ('ne', np.not_equal),
+    ('neg', np.negative), ('not_', np.logical_not), ('or_', np.bitwise_or),
+    ('pos', np.positive), ('pow', np.power), ('rshift', np.right_shift),
+    ('sub', np.subtract), ('truediv', np.true_divide), ('xor', np.bitwise_xor))
+    if hasattr(operator, k)}
+vectorized[abs] = np.absolute
+
+
+def s_eval_columnar(element, scope):
+    """
+    Evaluates the element like s_eval_in_scope, but with heads from
+    vectorized replaced by their vectorized equivalents, so it works
+    on whole arrays, and scalars broadcast as NumPy does.
+
+    If and cond become np.where and np.select. Unlike their usual forms,
+    every branch is evaluated, for every row, so they must not have
+    side effects. cond needs an Else.
+    >>> from operator import lt
+    >>> from drython.s_expression import S
+    >>> x = np.arange(5)
+    >>> s_eval_columnar(S(cond, S(lt, S.x, 1), 'low', S(lt, S.x, 3), 'mid',
+    ...                   Else='high'), dict(x=x))
+    array(['low', 'mid', 'mid', 'high', 'high'], dtype='<U4')
+
+    Other macros are expanded first. Anything else without a vectorized
+    equivalent raises ColumnarError, rather than silently running per row.
+    >>> s_eval_columnar(S(round, S.x), dict(x=x))
+    Traceback (most recent call last):
+      ...
+    drython.columnar.ColumnarError: no vectorized equivalent of <built-in function round>
+    """
+    if not s_evaluable(element):
+        return element
+    if type(element) is Symbol:
+        return s_eval_in_scope(element, scope)
+    if type(element) is Quote:
+        return element.item
+    if type(element) is SIf:
+        return np.where(*(s_eval_columnar(e, scope)
+                          for e in (element.boolean, element.then, element.Else)))
+    if type(element) is not SExpression or not element.args:
+        raise ColumnarError('no vectorized equivalent of {0!r}'.format(element))
+    try:
+        head = s_eval_in_scope(element.args[0], scope)
+        if head is cond:
+            return _select(element, scope)
+        if hasattr(head, '_macro_'):
+            return s_eval_columnar(element.expansion(head), scope)
+        try:
+            func = vectorized[head]
+        except (KeyError, TypeError):  # TypeError if unhashable
+            raise ColumnarError('no vectorized equivalent of {0!r}'.format(head))
+        return func(*[s_eval_columnar(a, scope) for a in element.args[1:]],
+                    **{k: s_eval_columnar(v, scope) for k, v in element.kwargs.items()})
+    except ColumnarError:
+        raise  # not a failure of this element, but of the whole evaluation.
+    except BaseException as be:
+        element._s_raise(be)
+
+
+def _select(element, scope):
+    pairs = element.args[1:]
+    if len(pairs) % 2 or set(element.kwargs) != {'Else'}:
+        raise ColumnarError('cond needs condition/value pairs, and an Else')
+    values = [s_eval_columnar(e, scope) for e in pairs]
+    return np.select(values[::2], values[1::2], s_eval_columnar(element.kwargs['Else'], scope))
@@ -110,6 +110,9 @@ def _private():
         def __hash__(self):
             return 0
 
+        def __reduce__(self):
+            return 'Empty'  # pickles by name, so unpickles as the same one.
+
     __test__[EmptyType.__name__] = EmptyType.__doc__
 
     res = EmptyType()
@@ -591,19 +594,40 @@ def call(cls):
 
 
 if sys.version_info[0] >= 3:  # pragma: no cover
-    exec ("class Abstract(metaclass=ABCMeta):pass")
+    exec ("class Abstract(metaclass=ABCMeta):__slots__ = ()")
 else:  # pragma: no cover
     class Abstract(object):
         __metaclass__ = ABCMeta
+        __slots__ = ()
 
 
 class SEvaluable(Abstract):
+    __slots__ = ()
     _s_evaluable_ = None
 
     @abstractmethod
     def s_eval(self, scope):
         pass  # pragma: no cover
 
+    def s_compile(self, env):
+        """
+        returns a function of a scope that does what s_eval does.
+        Override to do the work that doesn't depend on the scope once,
+        ahead of time. The default just defers to s_eval.
+
+        env describes the scopes the result will run in. Since the
+        default doesn't know what s_eval might bind, it taints env.
+        """
+        env.taint()
+        return self.s_eval
+
+    def s_map(self, func):
+        """
+        returns a copy with func applied to each element this would
+        evaluate. The default has none, so returns self.
+        """
+        return self
+
 
 __all__ = [e for e in globals().keys()
            if not e.startswith('_')
@@ -15,12 +15,15 @@
 # TODO: docstring macro.py
 from __future__ import absolute_import, division
 from collections import MutableMapping
+from copy import copy
 from functools import wraps
 from itertools import chain
 
 from drython.statement import Print
-from drython.core import partition, identity, SEvaluable, interleave, apply
-from drython.s_expression import _S, S, macro, s_eval_in_scope, flatten_sexpr, gensym, Symbol
+from drython.core import partition, identity, SEvaluable, interleave, apply, Empty
+from drython.s_expression import _S, S, macro, nocache, s_eval_in_scope, flatten_sexpr, gensym, Symbol
+from drython.s_expression import SExpression, s_evaluable
+from drython.s_expression import compile as _compile
 from drython.statement import do, Raise
 from drython.expression import Elif, entuple
 
@@ -35,17 +38,44 @@ def s_eval(body):
 
 
 class SEval(SEvaluable):
+    __slots__ = 'body',
+
     def __init__(self, body):
         self.body = body
 
     def s_eval(self, scope):
-        if hasattr(self.body, '_s_evaluable_') and isinstance(self.body, SEvaluable):
+        if s_evaluable(self.body):
             res = self.body.s_eval(scope)
-            if hasattr(self.body, '_s_evaluable_') and isinstance(res, SEvaluable):
+            if s_evaluable(res):
                 return res.s_eval(scope)
             return res
         return self.body
 
+    def s_compile(self, env):
+        body = _compile(self.body, env)
+        env.taint()  # res is only known at run time.
+
+        def s_eval(scope):
+            res = body(scope)
+            if s_evaluable(res):
+                return res.s_eval(scope)
+            return res
+
+        return s_eval
+
+    def s_map(self, func):
+        return SEval(func(self.body))
+
+    def __reduce__(self):
+        return SEval, (self.body,)
+
+    # see help(drython.s_expression.s_eval_iterative)
+    def s_first(self):
+        return self.body
+
+    def s_then(self, res):
+        return res
+
 
 class ScopeError(NameError, KeyError):
     pass
@@ -101,10 +131,63 @@ class Scope(MutableMapping):
         return self
 
 
+class Frame(Scope):
+    """
+    A Scope for compiled lambdas. The parameters are kept in numbered
+    slots, so compiled Symbols can load them without searching by name.
+    see help(drython.s_expression.StaticScope)
+
+    Otherwise it works like any other Scope.
+    >>> frame = Frame(dict(x=1), {'y': 0, 'z': 1}, [2, 3])
+    >>> frame['x'], frame['y'], frame.slots
+    (1, 2, [2, 3])
+    >>> frame['z'] = 4
+    >>> frame['w'] = 5
+    >>> sorted(frame.items()), frame.slots
+    ([('w', 5), ('y', 2), ('z', 4)], [2, 4])
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, parent, index, slots):
+        self.parent = parent
+        self.index = index
+        self.slots = slots
+        self.vars = {}
+        self.nonlocals = set()
+        self.display = getattr(parent, 'display', ()) + (self,)
+
+    def __len__(self):
+        return len(self.index) + len(self.vars)
+
+    def __iter__(self):
+        return chain(self.index, self.vars)
+
+    def __getitem__(self, name):
+        try:
+            return self.slots[self.index[name]]
+        except KeyError:
+            return Scope.__getitem__(self, name)
+
+    def __setitem__(self, name, val):
+        if name in self.index and name not in self.nonlocals:
+            self.slots[self.index[name]] = val
+        else:
+            Scope.__setitem__(self, name, val)
+
+    def __repr__(self):
+        return ('Frame(local={1}, parent={0})'.format(self.parent, dict(self))
+                + ('.Nonlocal({0})'.format(self.nonlocals) if self.nonlocals else ''))
+
+
 class ScopeGetter(SEvaluable):
+    __slots__ = ()
+
     def s_eval(self, scope):
         return scope
 
+    def __reduce__(self):
+        return ScopeGetter, ()
+
 
 @macro
 def scope():
@@ -112,14 +195,33 @@ def scope():
 
 
 class SSetQ(SEvaluable):
+    __slots__ = 'pairs',
+
     def __init__(self, pairs):
         assert len(pairs) % 2 == 0
-        self.pairs = partition(pairs)
+        self.pairs = tuple(partition(pairs))
 
     def s_eval(self, scope):
         for k, v in self.pairs:
             scope[k] = s_eval_in_scope(v, scope)
 
+    def s_compile(self, env):
+        for k, v in self.pairs:
+            env.assign(k)
+        pairs = tuple((k, _compile(v, env)) for k, v in self.pairs)
+
+        def setq(scope):
+            for k, v in pairs:
+                scope[k] = v(scope)
+
+        return setq
+
+    def s_map(self, func):
+        return SSetQ(tuple(chain.from_iterable((k, func(v)) for k, v in self.pairs)))
+
+    def __reduce__(self):
+        return SSetQ, (tuple(chain.from_iterable(self.pairs)),)
+
 
 @macro
 def setq(*pairs):
@@ -138,40 +240,98 @@ def setq(*pairs):
     return SSetQ(pairs)
 
 
+_unbound = object()
+
+
 class SLambda(SEvaluable):
+    __slots__ = ('body', 'block', 'keys', 'defaults', 'names', 'optional', 'signature',
+                 'star', 'stars')
+
     def __init__(self, body, required=(), optional=(), star=None, stars=None):
-        def _s_eval_helper(scope):
-            assert len(optional) % 2 == 0
-            pairs = tuple(partition(optional))
-            keys, defaults = zip(*pairs) if pairs else ((), ())
-            defaults = S(entuple, *defaults).s_eval(scope)
+        assert len(optional) % 2 == 0
+        pairs = tuple(partition(optional))
+        self.body = body
+        # one S(do, ...) for the body, so compile can tell it's the same
+        # body when it compiles this lambda again.
+        self.block = S(do, *body)
+        self.keys, self.defaults = zip(*pairs) if pairs else ((), ())
+        self.names = (tuple(required) + self.keys
+                      + ((star,) if star else ())
+                      + ((stars,) if stars else ()))
+        self.optional = range(len(required), len(required) + len(self.keys))
+        self.star, self.stars = star, stars
+        # parse the signature once, not every time a function is made.
+        self.signature = compile(
+            '''lambda {0}:__builtins__[0](__builtins__[1]())'''.format(
+                ','.join(
+                    ((','.join(required),) if required else ())
+                    + ((','.join(
+                        map('{0}=_'.format, self.keys)),) if self.keys else ())
+                    + (('*%s' % star,) if star else ())
+                    + (('**' + stars,) if stars else ()))),
+            '<fn>', 'eval')
 
-            def Lambda(local):
-                bindings = dict(zip(keys, defaults))
-                for k, v in local.items():
-                    if v != _sentinel:
-                        bindings[k] = v
-                return S(do, *body).s_eval(Scope(scope, bindings))
-
-            _sentinel = object()
-            func = eval(
-                '''lambda {0}:__builtins__[0](__builtins__[1]())'''.format(
-                    ','.join(
-                        ((','.join(required),) if required else ())
-                        + ((','.join(
-                            map('{0}=_'.format, keys)),) if keys else ())
-                        + (('*%s' % star,) if star else ())
-                        + (('**' + stars,) if stars else ()))),
-                # can't gensym, but __builtins__ should never be used as a parameter name
-                dict(_=_sentinel, __builtins__=(Lambda, locals)))
-            # TODO: set func defaults tuple, or is that an implementation detail?
-
-            return func
-
-        self._s_eval_helper = _s_eval_helper
+    # noinspection PyPep8Naming
+    def _function(self, Lambda):
+        # can't gensym, but __builtins__ should never be used as a parameter name
+        return eval(self.signature, dict(_=_unbound, __builtins__=(Lambda, locals)))
+        # TODO: set func defaults tuple, or is that an implementation detail?
 
     def s_eval(self, scope):
-        return self._s_eval_helper(scope)
+        keys = self.keys
+        defaults = S(entuple, *self.defaults).s_eval(scope)
+        body = self.block
+
+        # noinspection PyPep8Naming
+        def Lambda(local):
+            bindings = dict(zip(keys, defaults))
+            for k, v in local.items():
+                if v is not _unbound:
+                    bindings[k] = v
+            return body.s_eval(Scope(scope, bindings))
+
+        return self._function(Lambda)
+
+    def s_compile(self, env):
+        names = self.names
+        optional = self.optional
+        defaults = S(entuple, *self.defaults).s_compile(env)
+        body, index = env.compile_frame(names, self.block)
+
+        def s_eval(scope):
+            default_values = defaults(scope)
+
+            # noinspection PyPep8Naming
+            def Lambda(local):
+                slots = [local[n] for n in names]
+                for i, v in zip(optional, default_values):
+                    if slots[i] is _unbound:
+                        slots[i] = v
+                return body(Frame(scope, index, slots))
+
+            return self._function(Lambda)
+
+        return s_eval
+
+    def s_map(self, func):
+        res = copy(self)
+        res.body = tuple(map(func, self.body))
+        res.block = S(do, *res.body)
+        res.defaults = tuple(map(func, self.defaults))
+        return res
+
+    def __reduce__(self):
+        required = len(self.names) - len(self.keys) - bool(self.star) - bool(self.stars)
+        return SLambda, (self.body, self.names[:required],
+                         tuple(chain.from_iterable(zip(self.keys, self.defaults))),
+                         self.star, self.stars)
+
+    def __copy__(self):
+        # without compiling the signature again, as __reduce__ would.
+        res = object.__new__(SLambda)
+        for slot in SLambda.__slots__:
+            setattr(res, slot, getattr(self, slot))
+        return res
 
 
 @macro
@@ -252,6 +412,8 @@ def let1(symbol, value, *body):
 # , star=S.args, stars=S.kwargs).s_eval(globals())
 
 class SLambda0(SEvaluable):
+    __slots__ = 'body',
+
     def __init__(self, body):
         self.body = body
 
@@ -261,6 +423,23 @@ class SLambda0(SEvaluable):
 
         return l0
 
+    def s_compile(self, env):
+        body, index = env.compile_frame((), self.body)
+
+        def s_eval(scope):
+            def l0():
+                return body(Frame(scope, index, []))
+
+            return l0
+
+        return s_eval
+
+    def s_map(self, func):
+        return SLambda0(func(self.body))
+
+    def __reduce__(self):
+        return SLambda0, (self.body,)
+
 
 # noinspection PyPep8Naming
 @macro
@@ -270,6 +449,8 @@ def L0(*body):
 
 
 class SLambda1(SEvaluable):
+    __slots__ = 'body', 'symbol'
+
     def __init__(self, symbol, body):
         self.body = body
         self.symbol = symbol
@@ -280,6 +461,23 @@ class SLambda1(SEvaluable):
 
         return l1
 
+    def s_compile(self, env):
+        body, index = env.compile_frame((self.symbol,), self.body)
+
+        def s_eval(scope):
+            def l1(arg):
+                return body(Frame(scope, index, [arg]))
+
+            return l1
+
+        return s_eval
+
+    def s_map(self, func):
+        return SLambda1(self.symbol, func(self.body))
+
+    def __reduce__(self):
+        return SLambda1, (self.symbol, self.body)
+
 
 # noinspection PyPep8Naming
 @macro
@@ -289,6 +487,8 @@ def L1(symbol, *body):
 
 
 class SLambda2(SEvaluable):
+    __slots__ = 'body', 'x', 'y'
+
     def __init__(self, x, y, body):
         self.body = body
         self.x = x
@@ -300,6 +500,23 @@ class SLambda2(SEvaluable):
 
         return l2
 
+    def s_compile(self, env):
+        body, index = env.compile_frame((self.x, self.y), self.body)
+
+        def s_eval(scope):
+            def l2(x, y):
+                return body(Frame(scope, index, [x, y]))
+
+            return l2
+
+        return s_eval
+
+    def s_map(self, func):
+        return SLambda2(self.x, self.y, func(self.body))
+
+    def __reduce__(self):
+        return SLambda2, (self.x, self.y, self.body)
+
 
 # noinspection PyPep8Naming
 @macro
@@ -309,6 +526,8 @@ def L2(x, y, *body):
 
 
 class SLambdaA(SEvaluable):
+    __slots__ = 'body', 'args'
+
     def __init__(self, args, body):
         self.body = body
         self.args = args
@@ -319,6 +538,23 @@ class SLambdaA(SEvaluable):
 
         return la
 
+    def s_compile(self, env):
+        body, index = env.compile_frame((self.args,), self.body)
+
+        def s_eval(scope):
+            def la(*args):
+                return body(Frame(scope, index, [args]))
+
+            return la
+
+        return s_eval
+
+    def s_map(self, func):
+        return SLambdaA(self.args, func(self.body))
+
+    def __reduce__(self):
+        return SLambdaA, (self.args, self.body)
+
 
 # noinspection PyPep8Naming
 @macro
@@ -407,12 +643,21 @@ def La(args, *body):
 
 
 class SNonlocal(SEvaluable):
+    __slots__ = 'symbols',
+
     def __init__(self, symbols):
         self.symbols = symbols
 
     def s_eval(self, scope):
         scope.Nonlocal(*self.symbols)
 
+    def s_compile(self, env):
+        env.declare_nonlocal(self.symbols)
+        return self.s_eval
+
+    def __reduce__(self):
+        return SNonlocal, (self.symbols,)
+
 
 # noinspection PyPep8Naming
 @macro
@@ -434,6 +679,38 @@ def Nonlocal(*symbols):
 #     return SThunk(body)
 
 
+class SIf(SEvaluable):
+    __slots__ = 'boolean', 'then', 'Else'
+
+    # noinspection PyPep8Naming
+    def __init__(self, boolean, then, Else):
+        self.boolean = boolean
+        self.then = then
+        self.Else = Else
+
+    def s_eval(self, scope):
+        if s_eval_in_scope(self.boolean, scope):
+            return s_eval_in_scope(self.then, scope)
+        return s_eval_in_scope(self.Else, scope)
+
+    def s_compile(self, env):
+        boolean, then, Else = (_compile(x, env) for x in (self.boolean, self.then, self.Else))
+        return lambda scope: then(scope) if boolean(scope) else Else(scope)
+
+    def s_map(self, func):
+        return SIf(func(self.boolean), func(self.then), func(self.Else))
+
+    def __reduce__(self):
+        return SIf, (self.boolean, self.then, self.Else)
+
+    # see help(drython.s_expression.s_eval_iterative)
+    def s_first(self):
+        return self.boolean
+
+    def s_then(self, boolean):
+        return self.then if boolean else self.Else
+
+
 # noinspection PyPep8Naming
 @macro
 def If(boolean, then, Else=S()):
@@ -452,10 +729,7 @@ def If(boolean, then, Else=S()):
     ...   S(Print, 'else'))()
     else
     """
-    return S(s_eval,
-             S((Else, then).__getitem__,
-               S(bool,
-                 boolean)))
+    return SIf(boolean, then, Else)
 
 
 # noinspection PyPep8Naming
@@ -512,6 +786,7 @@ def cond(*rest, **Else):
 
 
 @macro
+@nocache  # the attributes could change between evaluations.
 def dot(obj, *names):
     """
     attribute and index/key access macro
@@ -535,6 +810,89 @@ def dot(obj, *names):
     return res
 
 
+def macroexpand(element, scope=Empty):
+    """
+    Expands the element until it's no longer headed by a macro.
+    A Symbol head names a macro if the scope binds it to one.
+    >>> spam = macroexpand(S(If, S.x, 1, 0))
+    >>> spam  # doctest: +ELLIPSIS
+    <drython.macro.SIf object at ...>
+    >>> spam.s_eval(dict(x=True))
+    1
+
+    Anything not headed by a macro is returned as is.
+    >>> macroexpand(S(Print, S(If, S.x, 1, 0)))  # doctest: +ELLIPSIS
+    S(<built-in function print>,
+      S(<function If at ...>,
+        S.x,
+        1,
+        0))
+    """
+    while isinstance(element, SExpression) and element.args:
+        head = element.args[0]
+        if isinstance(head, Symbol):
+            try:
+                head = scope[str(head)]
+            except KeyError:
+                break
+        if not hasattr(head, '_macro_') or hasattr(head, '_nocache_'):
+            break
+        element = element.expansion(head)
+    return element
+
+
+def macroexpand_all(element, scope=Empty):
+    """
+    Expands every macro in the element, leaving a tree that evaluates
+    the same, but without expanding anything. Use it to do all the
+    expansion up front, rather than as evaluation reaches each macro.
+    >>> from operator import add
+    >>> spam = macroexpand_all(S(L1, S.a, S(If, S.a, S(add, S.a, 1), 0)))
+    >>> spam.body  # doctest: +ELLIPSIS
+    S(<function do at ...>,
+      <drython.macro.SIf object at ...>)
+    >>> from drython.s_expression import expansion_counts
+    >>> before = dict(expansion_counts)
+    >>> spam.s_eval({})(41)
+    42
+    >>> before == expansion_counts
+    True
+
+    Symbol heads are resolved in the scope, so its macros expand too.
+    Beware that this ignores anything a lambda or setq would bind
+    under the same name. Macros marked @nocache are left in place,
+    as is any S-expression whose head is one, or a Symbol the scope
+    doesn't bind, or anything else that might evaluate to a macro,
+    since its arguments might not be code.
+    >>> spam = S(S.f, S(If, S.x, 1, 0))
+    >>> macroexpand_all(spam) is spam
+    True
+    """
+    element = macroexpand(element, scope)
+    if isinstance(element, SExpression) and element.args:
+        first = element.args[0]
+        head = macroexpand_all(first, scope)
+        if _may_be_macro(head, scope):
+            return element
+        return element.s_map(
+            lambda e: head if e is first else macroexpand_all(e, scope))
+    if s_evaluable(element):
+        return element.s_map(lambda e: macroexpand_all(e, scope))
+    return element
+
+
+def _may_be_macro(head, scope):
+    # like optimize._calls_function, but for a head already expanded.
+    if isinstance(head, Symbol):
+        try:
+            head = scope[str(head)]
+        except KeyError:
+            return True
+    elif s_evaluable(head):
+        return not isinstance(head, (SLambda, SLambda0, SLambda1, SLambda2, SLambdaA))
+    return hasattr(head, '_macro_')
+
+
 def _private():
     # _sentinel = object()  # used only for is check
     _sentinel = S()  # used only for is check
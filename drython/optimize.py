@@ -0,0 +1,299 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Optimization passes for S-expressions.
+
+Each pass takes a tree and returns a tree that evaluates the same way,
+but with less work, along with a count of what it changed. Passes
+expand macros first (see help(drython.macro.macroexpand_all)), so they
+can see the code a macro would produce.
+
+The passes rely on drython.s_expression.pure to know which functions
+they may call early, or fewer times.
+>>> from operator import add, mul
+>>> from drython.s_expression import S
+>>> fold_constants(S(add, S(mul, 4, 10), 2))
+(42, 2)
+"""
+
+# optimize depends on core, statement, s_expression, and macro.
+
+from __future__ import absolute_import, division
+from copy import copy
+from itertools import chain
+
+from drython.core import identity
+from drython.statement import do
+from drython.s_expression import S, SExpression, Symbol, Quote, pure, s_evaluable, gensym
+from drython.macro import macroexpand_all, let_n, SIf, SNonlocal
+from drython.macro import SLambda, SLambda0, SLambda1, SLambda2, SLambdaA
+
+# Values a pass can put in the tree in place of the code that made
+# them. A mutable one would be shared by every later evaluation.
+_immutable = frozenset([int, float, complex, str, bytes, bool, type(None)])
+
+
+def _constant(value):
+    if type(value) in _immutable:
+        return True
+    if type(value) in (tuple, frozenset):
+        return all(map(_constant, value))
+    return False
+
+
+_functions = SLambda, SLambda0, SLambda1, SLambda2, SLambdaA
+
+
+def _calls_function(sexpr):
+    # False if the head could be a macro, since a macro's arguments
+    # might not be code.
+    head = sexpr.args[0]
+    if s_evaluable(head):
+        return isinstance(head, _functions)
+    return not hasattr(head, '_macro_')
+
+
+def fold_constants(element):
+    """
+    Evaluates every pure call with constant arguments ahead of time,
+    and puts the result in its place. Returns the new tree, and how
+    many S-expressions it replaced.
+    >>> from operator import add, mul
+    >>> from drython.s_expression import S
+    >>> from drython.expression import entuple
+    >>> fold_constants(S(entuple, S(add, S.x, S(mul, 4, 10)), S(add, 1, 1)))  # doctest: +ELLIPSIS
+    (S(<function entuple at ...>,
+      S(<built-in function add>,
+        S.x,
+        40),
+      2), 2)
+
+    Anything else, including a call that raises, is left to run later.
+    >>> from drython.statement import Print
+    >>> fold_constants(S(add, 1, S(Print, 'spam')))
+    (S(<built-in function add>,
+      1,
+      S(<built-in function print>,
+        'spam')), 0)
+    >>> fold_constants(S(mul, [1], 2))[1]  # lists could change.
+    0
+    >>> fold_constants(S(add, 1, 'a'))[1]
+    0
+    """
+    removed = [0]
+
+    def fold(element):
+        if isinstance(element, SExpression):
+            if not element.args:
+                return element
+            if not _calls_function(element):
+                head = fold(element.args[0])
+                if head is element.args[0]:
+                    return element
+                return S(head, *element.args[1:], **element.kwargs)
+            element = element.s_map(fold)
+            head, args = element.args[0], element.args[1:]
+            if (head in pure
+                    and all(map(_constant, args))
+                    and all(map(_constant, element.kwargs.values()))):
+                try:
+                    value = head(*args, **element.kwargs)
+                except Exception:
+                    return element  # let it raise when and how it would have.
+                if _constant(value):
+                    removed[0] += 1
+                    return value
+            return element
+        if s_evaluable(element):
+            return element.s_map(fold)
+        return element
+
+    return fold(macroexpand_all(element)), removed[0]
+
+
+def eliminate_common(element, heads=pure):
+    """
+    Finds pure calls made more than once with the same arguments, and
+    makes them once, binding the result to a gensym with let_n. Returns
+    the new tree, and how many calls it shared. Only heads in the given
+    collection count as pure; drython.s_expression.pure by default.
+    >>> from operator import add, mul, getitem
+    >>> from drython.s_expression import S
+    >>> from drython.macro import If
+    >>> spam = S(If, S(getitem, S.d, 'k'),
+    ...          S(mul, S(getitem, S.d, 'k'), 2),
+    ...          S(add, S(getitem, S.d, 'k'), 1))
+    >>> eggs, shared = eliminate_common(spam)
+    >>> shared
+    1
+    >>> eggs.args[1]  # doctest: +ELLIPSIS
+    (Symbol('<cse#...>'), S(<built-in function getitem>,
+      S.d,
+      'k'))
+    >>> eggs.s_eval(dict(d=dict(k=3)))
+    6
+
+    A call is shared only if the code always makes it at least once,
+    so the pass doesn't add work, or errors, to any path through it.
+    >>> eliminate_common(S(If, S.x, S(getitem, S.d, 'k'), S(getitem, S.d, 'k')))[1]
+    0
+
+    Calls with the same arguments are assumed to give the same result,
+    so the code shouldn't change an object a pure call is given while
+    it runs. A shared call is made before the code it was taken from,
+    so if it raises, side effects that came before it won't happen.
+    Code that can bind Symbols (setq, Nonlocal, s_eval, scope, or a
+    head only known at run time) is left as is.
+    """
+    shared = [0]
+
+    def nested(e):
+        return _map_region(e, nested, region)
+
+    def region(body):
+        # body runs as a unit, in one scope: a whole tree, or a lambda's.
+        body = nested(body)
+        if not _safe(body):
+            return body
+        bindings = []
+        while True:
+            target = _most_shared([body] + [e for _, e in bindings], heads)
+            if target is None:
+                break
+            symbol = gensym('cse')
+            body = _replace(body, target, symbol)
+            bindings = [(s, _replace(e, target, symbol)) for s, e in bindings]
+            # a smaller call may be in a bigger one's binding, so goes first.
+            bindings.insert(0, (symbol, target))
+            shared[0] += 1
+        if not bindings:
+            return body
+        return S(let_n, tuple(chain.from_iterable(bindings)), body)
+
+    return region(macroexpand_all(element)), shared[0]
+
+
+def _map_region(element, func, body):
+    # rebuilds the element with func applied to each of its children
+    # that run in the same scope, and body applied to lambda bodies.
+    if isinstance(element, SExpression):
+        if not element.args:
+            return element
+        if _calls_function(element):
+            return element.s_map(func)
+        head = func(element.args[0])  # the others might not be code.
+        if head is element.args[0]:
+            return element
+        return S(head, *element.args[1:], **element.kwargs)
+    if isinstance(element, SIf):
+        return element.s_map(func)
+    if isinstance(element, SLambda):
+        res = copy(element)
+        sequence = body(element.block)
+        if sequence is not element.block:
+            res.body = sequence,
+            res.block = S(do, sequence)
+        res.defaults = tuple(map(func, element.defaults))
+        return res
+    if isinstance(element, _functions):
+        res = copy(element)
+        res.body = body(element.body)
+        return res
+    return element
+
+
+def _children(element):
+    # yields (child, conditional) for the children _map_region maps.
+    if isinstance(element, SIf):
+        return (element.boolean, False), (element.then, True), (element.Else, True)
+    found = []
+    _map_region(element, lambda e: found.append((e, False)) or e, identity)
+    return found
+
+
+def _safe(body):
+    # True if nothing in body might bind a Symbol in its scope at run
+    # time, so wrapping it in another scope won't change what it does.
+    safe = [True]
+
+    def visit(e):
+        if isinstance(e, SNonlocal):
+            safe[0] = False  # binds in an outer scope, from any depth.
+        elif s_evaluable(e):
+            e.s_map(visit)
+        return e
+
+    def check(e):
+        if not (type(e) in _inert or isinstance(e, _functions) or not s_evaluable(e)):
+            safe[0] = False  # setq, s_eval, scope, or unknown.
+        elif isinstance(e, SExpression) and e.args and s_evaluable(e.args[0]):
+            if not isinstance(e.args[0], _functions):
+                safe[0] = False  # a head only known at run time.
+        for child, _ in _children(e):
+            check(child)
+
+    visit(body)
+    check(body)
+    return safe[0]
+
+
+_inert = frozenset([SExpression, SIf, Symbol, Quote])
+
+
+def _most_shared(elements, heads):
+    # returns the biggest pure call in elements made at least twice,
+    # and unconditionally at least once, or None if there isn't one.
+    counts = {}
+    order = []
+
+    def count(e, conditional):
+        if _pure_call(e, heads):
+            try:
+                seen = counts.setdefault(e, [0, True, len(order)])
+            except TypeError:  # an unhashable argument.
+                return
+            if seen[2] == len(order):
+                order.append(e)
+            seen[0] += 1
+            seen[1] = seen[1] and conditional
+        for child, branch in _children(e):
+            count(child, conditional or branch)
+
+    for e in elements:
+        count(e, False)
+    shared = [e for e in order if counts[e][0] > 1 and not counts[e][1]]
+    if not shared:
+        return None
+    return max(shared, key=_size)
+
+
+def _pure_call(element, heads):
+    if not (isinstance(element, SExpression) and element.args):
+        return False
+    head = element.args[0]
+    if s_evaluable(head) or head not in heads:
+        return False
+    return all(isinstance(a, Symbol) or not s_evaluable(a) or _pure_call(a, heads)
+               for a in chain(element.args[1:], element.kwargs.values()))
+
+
+def _size(element):
+    return 1 + sum(_size(e) for e, _ in _children(element))
+
+
+def _replace(element, target, symbol):
+    if isinstance(element, SExpression) and element == target:
+        return symbol
+    return _map_region(element, lambda e: _replace(e, target, symbol), identity)
@@ -0,0 +1,105 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Evaluation of S-expressions in other processes, to use more than one core.
+
+Trees are pickled to ship them. Functions in them pickle by qualified
+name, so they must be importable in the worker: defined at the top
+level of a module, not lambdas, or in a function, or a doctest.
+>>> from operator import add, mul
+>>> from drython.s_expression import S
+>>> list(s_eval_many(S(add, S(mul, S.x, 10), 2), [dict(x=x) for x in range(4)]))
+[2, 12, 22, 32]
+"""
+
+# parallel depends on s_expression.
+
+from __future__ import absolute_import, division
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+import pickle
+
+from drython.s_expression import compile
+
+# compiled programs, by their pickle, for as long as this process lives.
+_programs = {}
+MAX_PROGRAMS = 64
+
+
+def s_eval_many(element, scopes, executor=None, chunksize=256):
+    """
+    Evaluates the element in each of the scopes, on a process pool,
+    and yields the results in order, as they're ready.
+
+    Scopes are sent to the executor in chunks of chunksize, each with
+    the pickled element. A worker compiles the element once, and keeps
+    it for the next chunk. If no executor is given, a ProcessPoolExecutor
+    is made for the call, and shut down after.
+
+    Exceptions raise here, as they would have there, with the same
+    SExpressionException context. Results and scopes must pickle too.
+    """
+    program = pickle.dumps(element, pickle.HIGHEST_PROTOCOL)
+    own = executor is None
+    if own:
+        executor = ProcessPoolExecutor()
+    try:
+        for results in executor.map(_s_eval_chunk, repeat(program), _chunks(scopes, chunksize)):
+            for result in results:
+                yield result
+    finally:
+        if own:
+            executor.shutdown()
+
+
+def submit(executor, element, scope):
+    """
+    Evaluates the element in the scope on the executor, and returns
+    a Future of the result.
+    >>> from operator import add
+    >>> from drython.s_expression import S
+    >>> with ProcessPoolExecutor(1) as pool:
+    ...     submit(pool, S(add, S.x, 2), dict(x=40)).result()
+    42
+    """
+    return executor.submit(_s_eval_one, pickle.dumps(element, pickle.HIGHEST_PROTOCOL), scope)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _compiled(program):
+    try:
+        return _programs[program]
+    except KeyError:
+        if len(_programs) >= MAX_PROGRAMS:
+            _programs.clear()
+        compiled = _programs[program] = compile(pickle.loads(program))
+        return compiled
+
+
+def _s_eval_chunk(program, scopes):
+    compiled = _compiled(program)
+    return [compiled(scope) for scope in scopes]
+
+
+def _s_eval_one(program, scope):
+    return _compiled(program)(scope)
@@ -0,0 +1,232 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reads S-expressions from Lisp-style text.
+
+    (print 1 2 :sep "::")
+
+reads as
+
+    S(print, 1, 2, sep='::')
+
+when print is in the namespace the heads are looked up in.
+>>> from io import StringIO
+>>> from drython.statement import Print
+>>> for form in iter_read(StringIO(u'(print 1 2 :sep "::") (print x)'), {'print': Print}):
+...     form(x='spam')
+1::2
+spam
+
+Text is read a chunk at a time, and each top-level form is yielded as
+soon as it's whole, so memory doesn't grow with the size of the text,
+only with the size of the biggest form.
+
+The syntax:
+
+    (head arg... :key value...)  an S-expression, with keyword arguments.
+    [item...]                    a tuple, e.g. for let_n or fn.
+    'form                        S(quote, form)
+    `form                        S(quasiquote, form)
+    ~form                        S(unquote, form)
+    ~@form                       S(unquote_splice, form)
+    "text"                       a str, with Python's escapes. It may span lines.
+    42  -1.5  1e3                ints and floats, in decimal digits only,
+                                 so -inf or 1_000 is a Symbol.
+    True  False  None            themselves.
+    anything else                a Symbol. If it's a head, it's looked up
+                                 in the namespace. Dots look up attributes.
+    ; to the end of the line     a comment.
+
+Commas are whitespace.
+"""
+
+# reader depends on core, and s_expression.
+
+from __future__ import absolute_import, division
+from ast import literal_eval
+from io import BytesIO, StringIO
+import re
+import sys
+
+from drython.core import Empty
+from drython.s_expression import SExpression, Symbol, quote, quasiquote, unquote, unquote_splice
+
+if sys.version_info[0] == 2:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    _text, _strings = unicode, basestring
+
+    def _native(chunk):
+        # Python 2 reads text as strs, like its Symbols and keywords.
+        return chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
+else:  # pragma: no cover
+    _text = _strings = str
+
+    def _native(chunk):
+        return chunk
+
+CHUNK = 1 << 16
+
+# a token, after any whitespace and comments.
+_token = re.compile(r"""[\s,]*(?:;[^\n]*[\s,]*)*(?:
+     (?P<open>[(\[])
+    |(?P<close>[)\]])
+    |(?P<atom>[^\s,()\[\]"';`~:][^\s,()\[\]"';`~]*)
+    |(?P<str>"[^"\\]*(?:\\.[^"\\]*)*")
+    |(?P<key>:[^\s,()\[\]"';`~]+)
+    |(?P<prefix>~@|['`~])
+    |(?P<open_str>")                      # until it closes.
+    |(?P<bad>.)
+    |$)
+""", re.VERBOSE | re.DOTALL)
+(OPEN, CLOSE, ATOM, STR, KEY, PREFIX, OPEN_STR, BAD) = range(1, 9)
+
+_prefixes = {"'": quote, '`': quasiquote, '~': unquote, '~@': unquote_splice}
+_constants = {'True': True, 'False': False, 'None': None}
+_numeric = frozenset('0123456789+-.')
+# what every Python's int and float read alike: no inf, nan or _.
+_number = re.compile(r'[+-]?(?:([0-9]+)|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)\Z')
+
+
+class ReaderError(SyntaxError):
+    """raised for text that isn't a well-formed S-expression."""
+
+
+def iter_read(stream, namespace=Empty):
+    """
+    Reads the text stream, a str, or a file, and yields each of its
+    top-level forms as soon as it's read. Heads are looked up in the
+    namespace, if they're in it.
+    >>> from operator import add
+    >>> list(iter_read('(add x 1) [1 2.5 "3"] ; done', dict(add=add)))
+    [S(<built-in function add>,
+      S.x,
+      1), (1, 2.5, '3')]
+    """
+    if isinstance(stream, _strings):
+        stream = StringIO(stream) if isinstance(stream, _text) else BytesIO(stream)
+    tokens = _token.finditer
+    buffer = ''
+    eof = False
+    # each frame is [closer, items, kwargs, key], or a prefix's function.
+    frames = []
+    while True:
+        pos = size = len(buffer)
+        for m in tokens(buffer):
+            kind = m.lastindex
+            if m.end() == size and not eof or kind == OPEN_STR:
+                pos = m.start()  # it might go on in the next chunk.
+                break
+            if kind is None:
+                continue
+            text = m.group(kind)
+            if kind == ATOM:
+                value = _constants.get(text, Empty)
+                if value is Empty:
+                    value = _atom(text)
+            elif kind == OPEN:
+                frames.append([')' if text == '(' else ']', [], {}, None])
+                continue
+            elif kind == CLOSE:
+                if not frames or type(frames[-1]) is not list or frames[-1][0] != text:
+                    raise ReaderError('unexpected {0!r}'.format(text))
+                closer, items, kwargs, key = frames.pop()
+                if key is not None:
+                    raise ReaderError('no value for :{0}'.format(key))
+                if closer == ']':
+                    value = tuple(items)
+                else:
+                    if items and type(items[0]) is Symbol:
+                        items[0] = _resolve(items[0], namespace)
+                    value = SExpression(*items)
+                    if kwargs:
+                        value.kwargs = kwargs
+            elif kind == STR:
+                value = text[1:-1] if '\\' not in text else _string(text)
+            elif kind == KEY:
+                if not frames or type(frames[-1]) is not list or frames[-1][0] != ')':
+                    raise ReaderError('{0} is not in an S-expression'.format(text))
+                if frames[-1][3] is not None:
+                    raise ReaderError('no value for :{0}'.format(frames[-1][3]))
+                frames[-1][3] = text[1:]
+                continue
+            elif kind == PREFIX:
+                frames.append(_prefixes[text])
+                continue
+            else:
+                raise ReaderError('unreadable text: {0!r}'.format(buffer[m.start(kind):][:40]))
+            # a whole form. Wrap it in any prefixes, and put it where it goes.
+            while frames and type(frames[-1]) is not list:
+                value = SExpression(frames.pop(), value)
+            if not frames:
+                yield value
+            elif frames[-1][3] is None:
+                frames[-1][1].append(value)
+            else:
+                frames[-1][2][frames[-1][3]] = value
+                frames[-1][3] = None
+        if eof:
+            if pos < len(buffer):
+                raise ReaderError('unreadable text: {0!r}'.format(buffer[pos:][:40]))
+            if frames:
+                raise ReaderError('text ended in a form')
+            return
+        more = _native(stream.read(CHUNK))
+        eof = not more
+        buffer = buffer[pos:] + more
+
+
+def read(stream, namespace=Empty):
+    """
+    returns the first form in the text stream, a str, or a file.
+    Reading a file may read past it.
+    >>> read('(f x) (g y)')
+    S(S.f,
+      S.x)
+    """
+    for form in iter_read(stream, namespace):
+        return form
+    raise ReaderError('no forms to read')
+
+
+def _atom(text):
+    if text[0] in _numeric:
+        m = _number.match(text)
+        if m:
+            return int(text) if m.group(1) else float(text)
+    return Symbol(text)
+
+
+def _string(text):
+    # Python's escapes, but like a triple-quoted str, since a string
+    # can go on over lines. Any quote in it is escaped, so it can't
+    # end the triple quotes early.
+    try:
+        return literal_eval('""' + text + '""')
+    except (SyntaxError, ValueError) as e:
+        raise ReaderError('bad string {0}: {1}'.format(text[:40], e))
+
+
+def _resolve(symbol, namespace):
+    name, _, attrs = symbol.partition('.')
+    try:
+        value = namespace[name]
+    except KeyError:
+        return symbol  # not known until it's evaluated.
+    for attr in attrs.split('.') if attrs else ():
+        try:
+            value = getattr(value, attr)
+        except AttributeError:
+            raise ReaderError('{0}: no attribute {1!r}'.format(symbol, attr))
+    return value
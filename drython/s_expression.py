@@ -29,12 +29,16 @@ The `~` unquotes as in Clojure; `+` unquotes and splices.
 """
 # s_expression may safely depend on .core, .statement, and .expression
 
-from __future__ import absolute_import, division
+from __future__ import absolute_import, division, print_function
 from itertools import chain, count
 from keyword import iskeyword
 from operator import add
-from collections import Mapping
+from collections import Mapping, MutableMapping, MutableSet
+from functools import partial
 import logging as lg
+import operator
+import threading
+import weakref
 
 lg.basicConfig(filename='s_expression.py',
                # level=lg.DEBUG,
@@ -42,8 +46,9 @@ lg.basicConfig(filename='s_expression.py',
 import sys
 
 import collections
+from collections import Counter, OrderedDict
 
-from drython.core import SEvaluable
+from drython.core import SEvaluable, identity
 
 if sys.version_info[0] == 2:
     # noinspection PyUnresolvedReferences,PyCompatibility
@@ -52,8 +57,10 @@ else:
     from collections import UserString
 
 from drython.core import Empty
-from drython.expression import entuple, edict
-from drython.statement import Atom, Raise, Print
+from drython.expression import entuple, efset, edict
+from drython.statement import Atom, Raise, Print, LabeledBreak
+
+__test__ = {}
 
 
 # defines an interface used by SExpression, so belongs here, not in macro.py
@@ -67,7 +74,317 @@ def macro(func):
     return func
 
 
+def nocache(func):
+    """
+    Marks the macro as expanding differently each time, so its
+    expansion is never cached. see help(SExpression.expansion)
+    """
+    func._nocache_ = None
+    return func
+
+
+class Memo(object):
+    """
+    A pure function that remembers its most recent results, up to
+    maxsize of them, and counts its cache hits, misses, and evictions.
+    Make one with memo(), or @pure(memo=True).
+    >>> from operator import add
+    >>> spam = memo(add, maxsize=2)
+    >>> spam
+    memo(<built-in function add>, maxsize=2)
+    >>> S(spam, S(spam, 1, 2), S(spam, 1, 2))()
+    6
+    >>> spam.hits, spam.misses, spam.evictions
+    (1, 2, 0)
+
+    The least recently used result is dropped to make room.
+    >>> spam(3, 3), spam(1, 2), spam(4, 4)
+    (6, 3, 8)
+    >>> spam.evictions, (1, 2) in spam, (3, 3) in spam
+    (1, True, False)
+
+    Arguments must be hashable to be cached. Others are passed through
+    uncounted. Equal arguments of different types are cached separately.
+    >>> spam([1], [2]), spam.misses
+    ([1, 2], 3)
+    >>> spam(1.0, 2), spam(True, 2)
+    (3.0, 3)
+    """
+    __slots__ = 'func', 'maxsize', 'cache', 'hits', 'misses', 'evictions'
+
+    def __init__(self, func, maxsize=128):
+        assert maxsize > 0
+        self.func = func
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _key(args, kwargs):
+        key = args, tuple(map(type, args))
+        if kwargs:
+            key += (frozenset(kwargs.items()),
+                    frozenset((k, type(v)) for k, v in kwargs.items()))
+        return key
+
+    def __contains__(self, args):
+        """True if the result for the args is cached."""
+        try:
+            return self._key(args, Empty) in self.cache
+        except TypeError:
+            return False
+
+    def __call__(self, *args, **kwargs):
+        key = self._key(args, kwargs)
+        cache = self.cache
+        try:
+            result = cache.pop(key)
+        except TypeError:  # unhashable
+            return self.func(*args, **kwargs)
+        except KeyError:
+            result = self.func(*args, **kwargs)
+            self.misses += 1
+        else:
+            self.hits += 1
+        cache[key] = result  # now the most recently used.
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+            self.evictions += 1
+        return result
+
+    def clear(self):
+        self.cache.clear()
+
+    def __repr__(self):
+        return 'memo({0!r}, maxsize={1!r})'.format(self.func, self.maxsize)
+
+    def __reduce__(self):
+        # by name, if @pure(memo=...) put it there, else without the cache.
+        module = getattr(self.func, '__module__', None)
+        name = getattr(self.func, '__qualname__', getattr(self.func, '__name__', None))
+        if _import(module, name) is self:
+            return _import, (module, name)
+        return Memo, (self.func, self.maxsize)
+
+
+def _import(module, name):
+    # returns what the qualified name refers to, or None.
+    try:
+        __import__(module)
+        obj = sys.modules[module]
+        for attr in name.split('.'):
+            obj = getattr(obj, attr)
+        return obj
+    except (ImportError, AttributeError, KeyError, TypeError):
+        return None
+
+
+def memo(func, maxsize=128):
+    """
+    returns a Memo of the func, and adds it to pure.
+    see help(Memo)
+    """
+    return pure(func, memo=maxsize)
+
+
+class _Registry(object):
+    # Functions, in a set or a dict keyed by them, as members. Also a
+    # decorator that registers the function it decorates, with any
+    # options given, and returns what register returns.
+    __slots__ = 'members',
+    name = None
+
+    def __call__(self, func=None, *options, **kwoptions):
+        if func is None:
+            return lambda func: self(func, *options, **kwoptions)
+        return self.register(func, *options, **kwoptions)
+
+    def __contains__(self, func):
+        try:
+            return func in self.members
+        except TypeError:  # unhashable, so not registered.
+            return False
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __repr__(self):
+        return self.name
+
+
+def _private():
+    class PureRegistry(_Registry, MutableSet):
+        """
+        The set of functions known to be pure: given the same arguments,
+        they return the same result, and do nothing else. Optimizers may
+        call them early, or fewer times, when their arguments allow.
+        Also a decorator that adds the function it decorates.
+        >>> @pure
+        ... def double(x):
+        ...     return 2 * x
+        >>> double in pure
+        True
+
+        Non-mutating functions from the operator module are in by default,
+        as are the builders of immutable displays, entuple and efset.
+        >>> from operator import add, iadd
+        >>> add in pure, iadd in pure
+        (True, False)
+
+        With memo, adds a Memo of the function instead, which caches
+        up to memo results, or 128 if memo is True. see help(Memo)
+        >>> @pure(memo=True)
+        ... def triple(x):
+        ...     return 3 * x
+        >>> triple  # doctest: +ELLIPSIS
+        memo(<function triple at ...>, maxsize=128)
+        >>> triple(2), triple(2), triple.hits
+        (6, 6, 1)
+        """
+        __slots__ = ()
+        name = 'pure'
+
+        def __init__(self, funcs):
+            self.members = set(funcs)
+
+        def register(self, func, memo=None):
+            if memo:
+                func = Memo(func, *(() if memo is True else (memo,)))
+            self.add(func)
+            return func
+
+        def add(self, func):
+            self.members.add(func)
+
+        def discard(self, func):
+            self.members.discard(func)
+
+    __test__[PureRegistry.__name__] = PureRegistry.__doc__
+
+    # Some aren't in every version of Python.
+    return PureRegistry(
+        [getattr(operator, name) for name in (
+            'abs', 'add', 'and_', 'concat', 'contains', 'countOf', 'div', 'eq',
+            'floordiv', 'ge', 'getitem', 'gt', 'index', 'indexOf', 'inv',
+            'invert', 'is_', 'is_not', 'le', 'lshift', 'lt', 'matmul', 'mod',
+            'mul', 'ne', 'neg', 'not_', 'or_', 'pos', 'pow', 'rshift', 'sub',
+            'truediv', 'truth', 'xor')
+         if hasattr(operator, name)]
+        + [entuple, efset])
+
+
+pure = _private()
+del _private
+
+
+def _private():
+    class ParallelRegistry(_Registry, MutableMapping):
+        """
+        Heads whose arguments may be evaluated concurrently, mapped to
+        the executor to evaluate them on, or to None for the default
+        executor, a ThreadPoolExecutor, unless parallel_args.executor
+        is set to another. Only S-expression arguments are given their
+        own task; the rest are evaluated in the calling thread.
+
+        Worthwhile for heads of arguments that block, e.g. on I/O, but
+        the arguments could run in any order, even at the same time.
+        Also a decorator that adds the function it decorates.
+        >>> from threading import Barrier
+        >>> from drython.expression import entuple
+        >>> @parallel_args
+        ... def gather(*results):
+        ...     return results
+        >>> both = Barrier(2, timeout=10)  # only passed by two threads at once.
+        >>> spam = S(gather, S(both.wait), S(both.wait), S(entuple, 1, 2))()
+        >>> sorted(spam[:2]), spam[2]
+        ([0, 1], (1, 2))
+
+        Errors have the same context they would have had otherwise.
+        >>> S(gather, S(gather, S.x))()  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+          ...
+        drython.s_expression.SExpressionException: when evaluating
+        S(<function gather at ...>,
+          S(<function gather at ...>,
+            S.x))
+        """
+        __slots__ = '_executor',
+        name = 'parallel_args'
+
+        def __init__(self):
+            self.members = {}
+            self._executor = None
+
+        def register(self, func, executor=None):
+            self[func] = executor
+            return func
+
+        def __getitem__(self, func):
+            return self.members[func]
+
+        def __setitem__(self, func, executor):
+            self.members[func] = executor
+
+        def __delitem__(self, func):
+            del self.members[func]
+
+        @property
+        def executor(self):
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor()
+            return self._executor
+
+        @executor.setter
+        def executor(self, executor):
+            self._executor = executor
+
+        def executor_for(self, func):
+            return self.members[func] or self.executor
+
+    if sys.version_info[0] > 2:  # 2.7 has neither Barrier nor concurrent.futures.
+        __test__[ParallelRegistry.__name__] = ParallelRegistry.__doc__
+
+    return ParallelRegistry()
+
+
+parallel_args = _private()
+del _private
+_parallel_heads = parallel_args.members  # to check quickly if it's empty.
+_worker = threading.local()
+
+
+def _in_worker(evaluate, scope):
+    _worker.busy = True
+    try:
+        return evaluate(scope)
+    finally:
+        _worker.busy = False
+
+
+def _s_eval_parallel(jobs, scope, executor):
+    # jobs are (evaluate, worth a task) pairs. Returns the results in order.
+    if getattr(_worker, 'busy', False):
+        # nested in another's task, and the pool might have no more
+        # workers to wait on, so don't.
+        return [evaluate(scope) for evaluate, _ in jobs]
+    futures = [executor.submit(_in_worker, evaluate, scope) if task else None
+               for evaluate, task in jobs]
+    try:
+        return [f.result() if f else evaluate(scope)
+                for f, (evaluate, _) in zip(futures, jobs)]
+    finally:
+        for f in futures:
+            if f:
+                f.cancel()  # if the first one raised, the rest can stop.
+
+
 class SUnquotable(object):
+    __slots__ = ()
+
     def __invert__(self):
         return S(unquote, self)
 
@@ -76,6 +393,8 @@ class SUnquotable(object):
 
 
 class SQuotable(SUnquotable):
+    __slots__ = ()
+
     def __neg__(self):
         return S(quote, self)
 
@@ -86,15 +405,24 @@ def quote(item):
 
 
 class Quote(SEvaluable, SQuotable):
+    __slots__ = 'item',
+
     def __init__(self, item):
         self.item = item
 
     def __repr__(self):
         return 'Quote(%s)' % repr(self.item)
 
+    def __reduce__(self):
+        return Quote, (self.item,)
+
     def s_eval(self, scope):
         return self.item
 
+    def s_compile(self, env):
+        item = self.item
+        return lambda scope: item
+
 
 def args_kwargs(data):
     args = []
@@ -109,6 +437,42 @@ def args_kwargs(data):
     return args, kwargs
 
 
+# Every element an S-expression evaluates gets checked for an s_eval
+# method, and isinstance is slow for an ABC like SEvaluable, so the
+# method (or None) is looked up once per type, and cached here.
+# A weak dict would be slower to look in than the check it saves, so
+# the cache is cleared when full instead, so it can't keep alive every
+# class a program makes on the fly.
+_s_evals = {}
+_S_EVALS_MAX = 1024
+
+# The types of most literals, which evaluate to themselves.
+_literal_types = frozenset([int, float, complex, str, bytes, bool, type(None)])
+
+
+def _s_eval_of(cls):
+    if len(_s_evals) >= _S_EVALS_MAX:
+        _s_evals.clear()
+    if hasattr(cls, '_s_evaluable_') and issubclass(cls, SEvaluable):
+        s_eval = _s_evals[cls] = cls.s_eval
+    else:
+        s_eval = _s_evals[cls] = None
+    return s_eval
+
+
+def s_evaluable(element):
+    """
+    Tells if the element is SEvaluable, like isinstance would,
+    but faster. The answer is cached per type.
+    >>> s_evaluable(S.x), s_evaluable('x')
+    (True, False)
+    """
+    try:
+        return _s_evals[type(element)] is not None
+    except KeyError:
+        return _s_eval_of(type(element)) is not None
+
+
 def s_eval_in_scope(element, scope):
     """
     Evaluates the element in the given scope using its s_eval method, if present.
@@ -122,13 +486,354 @@ def s_eval_in_scope(element, scope):
     >>> s_eval_in_scope(10-7, globals())
     3
     """
-    if hasattr(element, '_s_evaluable_') and isinstance(element, SEvaluable):
-        return element.s_eval(scope)
-    return element
+    if not hasattr(element, '_s_evaluable_'):
+        return element  # a literal, usually, so skip the cache.
+    kind = type(element)
+    s_eval = _s_evals.get(kind, _s_eval_of)
+    if s_eval is _s_eval_of:
+        s_eval = _s_eval_of(kind)
+    if s_eval is None:
+        return element
+    return s_eval(element, scope)
+
+
+def _s_eval_all(elements, scope):
+    # s_eval_in_scope on each, without paying for a call per literal.
+    values = []
+    for element in elements:
+        try:
+            s_eval = _s_evals[type(element)]
+        except KeyError:
+            s_eval = _s_eval_of(type(element))
+        values.append(element if s_eval is None else s_eval(element, scope))
+    return values
+
+
+def s_eval_iterative(element, scope):
+    """
+    Evaluates the element in the given scope, like s_eval_in_scope,
+    but with an explicit stack instead of Python's, so the depth of
+    the tree isn't limited by the recursion limit. Past a little setup
+    per call, it costs no more per S-expression than s_eval does.
+    >>> from operator import add
+    >>> spam = 0
+    >>> for i in range(100000):
+    ...     spam = S(add, spam, S.x)
+    >>> s_eval_iterative(spam, dict(x=2))
+    200000
+
+    Macros still get their arguments unevaluated.
+    >>> from drython.macro import If
+    >>> s_eval_iterative(S(If, S.x, S(Print,'yes'), S(Print,'no')), dict(x=0))
+    no
+
+    An SEvaluable with s_first and s_then methods can also keep its
+    subexpressions off the Python stack: s_first() is evaluated first,
+    and s_then(value) returns the element to evaluate in its place.
+    Any other SEvaluable is evaluated with its own s_eval method.
+    """
+    # Each frame is a list of an S-expression, an iterator over its
+    # children after the head, the head's value, and then the values of
+    # those children so far. Given keywords, the head's value is wrapped
+    # to take theirs as positional ones, last. The root, and whatever is
+    # evaluated in another element's place, gets a frame of no
+    # S-expression, with identity for a head and that element its only
+    # child. The frame being filled is kept off the stack, until one of
+    # its children needs a frame of its own; its iterator then picks up
+    # where it left off when the frame is filled again. Also on the
+    # stack: a tuple of an S-expression, while its head is evaluated;
+    # an S-expression, while its macro's expansion is evaluated in its
+    # place; and any element that has s_then, while its first is.
+    stack = []
+    push, pop = stack.append, stack.pop
+    evals, literals = _s_evals, _literal_types
+    frame = [None, iter((element,)), identity]
+    try:
+        while True:
+            # Leaves are evaluated right here, rather than in frames.
+            for element in frame[1]:
+                kind = type(element)
+                if kind in literals:
+                    frame.append(element)
+                elif kind is Symbol:
+                    # Symbols hash and compare as strs, so skip the
+                    # copy to one that Symbol.s_eval makes.
+                    try:
+                        frame.append(scope[element])
+                    except KeyError:
+                        frame.append(element.s_eval(scope))  # for its error.
+                elif kind is SExpression and element.args:
+                    push(frame)
+                    head = element.args[0]
+                    kind = type(head)
+                    s_eval = evals.get(kind, _s_eval_of)
+                    if s_eval is None or kind in literals:
+                        pass  # a function, usually.
+                    elif kind is Symbol:
+                        try:
+                            head = scope[head]
+                        except KeyError:
+                            push(element)  # for its context.
+                            head = head.s_eval(scope)
+                            pop()
+                    elif s_eval is not _s_eval_of or _s_eval_of(kind) is not None:
+                        push((element,))
+                        frame = [None, iter((head,)), identity]
+                        break
+                    if hasattr(head, '_macro_'):
+                        push(element)
+                        frame = [None, iter((element.expansion(head),)), identity]
+                    elif element.kwargs:
+                        frame = [element, _rest(element), _keywords(head, element)]
+                    else:
+                        frame = [element, iter(element.args[1:]), head]
+                    break
+                else:
+                    s_eval = evals.get(kind, _s_eval_of)
+                    if s_eval is _s_eval_of:
+                        s_eval = _s_eval_of(kind)
+                    if s_eval is None:
+                        frame.append(element)
+                    elif hasattr(element, 's_then'):
+                        push(frame)
+                        push(element)
+                        frame = [None, iter((element.s_first(),)), identity]
+                        break
+                    else:
+                        frame.append(s_eval(element, scope))
+            else:
+                value = frame[2](*frame[3:])
+                # return the value to whatever was waiting for it.
+                while stack:
+                    frame = pop()
+                    kind = type(frame)
+                    if kind is list:
+                        frame.append(value)
+                        break
+                    if kind is tuple:  # the value is the head's.
+                        sexpr = frame[0]
+                        if hasattr(value, '_macro_'):
+                            push(sexpr)
+                            frame = [None, iter((sexpr.expansion(value),)), identity]
+                        else:
+                            frame = [sexpr, _rest(sexpr),
+                                     _keywords(value, sexpr) if sexpr.kwargs else value]
+                        break
+                    if kind is not SExpression:
+                        frame = [None, iter((frame.s_then(value),)), identity]
+                        break
+                    # else the value of a macro's expansion is its sexpr's.
+                else:
+                    return value
+    except LabeledBreak:
+        raise  # control flow, not an error.
+    except BaseException as be:
+        # add the context s_eval would have, from the innermost out,
+        # starting with the frame being filled, if it's not on the stack.
+        if type(frame) is list and frame[0] is not None and not any(
+                f is frame for f in stack):
+            push(frame)
+        for frame in reversed(stack):
+            if type(frame) is list or type(frame) is tuple:
+                frame = frame[0]
+            if type(frame) is SExpression:
+                try:
+                    Raise(SExpressionException(_Evaluating(frame)), From=be)
+                except SExpressionException as e:
+                    be = e
+        raise be
+
+
+def _rest(sexpr):
+    # the children after sexpr's head, its keyword arguments last.
+    return iter(sexpr.args[1:] + tuple(sexpr.kwargs.values()))
+
+
+def _keywords(func, sexpr):
+    # func, taking the values of sexpr's keyword arguments after its
+    # positional ones, in the order _rest gives them.
+    n = len(sexpr.args) - 1
+    keys = tuple(sexpr.kwargs)
+    return lambda *values: func(*values[:n], **dict(zip(keys, values[n:])))
+
+
+def compile(element, env=None):
+    """
+    Compiles the element into a function of a scope.
+
+    compile(element)(scope) does the same as s_eval_in_scope(element, scope),
+    but the work that doesn't depend on the scope is done only once, here.
+    Each SEvaluable compiles itself with its s_compile method.
+    >>> from operator import add, mul
+    >>> spam = compile(S(add,S(mul,S.x,10),2))
+    >>> spam(dict(x=4))
+    42
+    >>> spam(dict(x=2))
+    22
+
+    integers are not s-evaluable, so compile to themselves.
+    >>> compile(42)({})
+    42
+
+    Macros with a known head expand only once, at compile time,
+    rather than on every evaluation.
+    >>> from drython.macro import If
+    >>> spam = compile(S(If, S.x, S(Print,'yes'), S(Print,'no')))
+    >>> spam(dict(x=True))
+    yes
+    >>> spam(dict(x=False))
+    no
+
+    Symbols bound by enclosing lambdas compile to a direct load from
+    their Frame slot, rather than a search up the chain of Scopes.
+    see help(drython.s_expression.StaticScope)
+    >>> from drython.macro import L1
+    >>> spam = compile(S(S(L1, S.a, S(L1, S.b, S(add, S.a, S.b, ))), 40))
+    >>> spam({})(2)
+    42
+    """
+    if env is None:
+        env = StaticScope()
+    if s_evaluable(element):
+        return element.s_compile(env)
+    return lambda scope: element
+
+
+class StaticScope(object):
+    """
+    What compile knows about the scopes its output will run in.
+
+    A StaticScope with no parent stands for the scope passed to the
+    compiled function, which could hold anything. Each lambda body
+    compiles in a child StaticScope whose names are kept in
+    numbered slots of a drython.macro.Frame at run time.
+
+    A Symbol resolves to (depth, slot) when it's a parameter of an
+    enclosing lambda. Otherwise, it's looked up by name, from the
+    nearest scope that might have it: one that may setq it, or one
+    that can't be known until run time, or else the outermost scope.
+    >>> root = StaticScope()
+    >>> frame = StaticScope(StaticScope(root, (S.a, S.b)), (S.c,))
+    >>> frame.address('c'), frame.address('b'), frame.address('x')
+    ((0, 0), (1, 1), (2, None))
+    >>> frame.parent.assign(S.x)
+    >>> frame.address('x')
+    (1, None)
+    >>> frame.taint()
+    >>> frame.address('x'), frame.address('c')
+    ((0, None), (0, 0))
+    """
+
+    def __init__(self, parent=None, names=()):
+        self.parent = parent
+        self.names = tuple(names)
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.depth = parent.depth + 1 if parent else 0
+        self.root = parent.root if parent else self
+        if not parent:
+            # shared by a whole compilation; keyed by id(), so keep the node too.
+            self.facts = {}
+        self.assigned = set()  # names setq may bind here at run time
+        self.opaque = False  # anything might be bound here at run time
+        self.passed = set()  # names already resolved past this scope
+
+    def address(self, name):
+        """
+        returns (depth, slot) for name, or (depth, None) if it must be
+        looked up by name in the scope that many levels up.
+        """
+        env = self
+        while env.parent:
+            if name in env.index:
+                return self.depth - env.depth, env.index[name]
+            if env.opaque or name in env.assigned:
+                return self.depth - env.depth, None
+            env.passed.add(name)
+            env = env.parent
+        return self.depth, None
+
+    def assign(self, name):
+        """notes that setq may bind name in this scope at run time."""
+        self.assigned.add(name)
+
+    def declare_nonlocal(self, names):
+        """notes that setq may bind names in any enclosing scope."""
+        env = self
+        while env:
+            env.assigned.update(names)
+            env = env.parent
+
+    def taint(self):
+        """notes that code only known at run time may bind anything here."""
+        env = self
+        while env:
+            env.opaque = True
+            env = env.parent
+
+    def compile_frame(self, names, body):
+        """
+        compiles body to run in a Frame binding names, just inside this
+        scope. Returns the compiled body and the Frame's slot index.
+        """
+        # Symbols compile before a later setq or unknown code in the same
+        # body can be noticed, so compile again if that invalidated any.
+        seen = self.root.facts.get(id(body), (body, set(), False))
+        while True:
+            env = StaticScope(self, names)
+            env.assigned.update(seen[1])
+            env.opaque = seen[2]
+            compiled = compile(body, env)
+            self.root.facts[id(body)] = body, env.assigned, env.opaque
+            if not (env.passed & env.assigned or env.passed and env.opaque):
+                return compiled, env.index
+            seen = self.root.facts[id(body)]
 
 
 class SExpressionException(Exception):
-    pass
+    """
+    raised from any exception while evaluating an S-expression, to show
+    where it happened.
+    >>> from operator import add, truediv
+    >>> spam = S(add, 1, S(truediv, 1, 0))
+    >>> try:
+    ...     spam()
+    ... except SExpressionException as se:
+    ...     Print(se)
+    ...     Print(type(se.__cause__.__cause__).__name__)
+    when evaluating
+    S(<built-in function add>,
+      1,
+      S(<built-in function truediv>,
+        1,
+        0))
+    ZeroDivisionError
+
+    Exceptions for control flow, like Break and Return, pass through
+    unwrapped.
+    >>> from drython.statement import let, Return
+    >>> let(lambda: S(add, 1, S(Return, 42))())
+    42
+    """
+
+
+class _Evaluating(object):
+    # An SExpressionException message, only rendered if it's shown.
+    # Exceptions can pass through many S-expressions, and most get
+    # caught without a message ever being shown.
+    __slots__ = 'element',
+
+    def __init__(self, element):
+        self.element = element
+
+    def __str__(self):
+        return 'when evaluating\n' + repr(self.element)
+
+    def __repr__(self):
+        return repr(str(self))
+
+
+# How often SExpression.expansion found a macro's expansion cached.
+expansion_counts = Counter(hits=0, misses=0)
 
 
 class SExpression(Mapping, SEvaluable, SQuotable):
@@ -232,9 +937,167 @@ class SExpression(Mapping, SEvaluable, SQuotable):
     def __len__(self):
         return len(self.args) + len(self.kwargs)
 
+    # Programs can have a great many nodes, so no __dict__ for each.
+    # _expanded and _hash are only set once they're needed.
+    # (Python 2's Mapping has no __slots__, so it already has __weakref__.)
+    __slots__ = ('args', 'kwargs', '_expanded', '_hash') + (
+        () if hasattr(Mapping, '__weakref__') else ('__weakref__',))
+
     def __init__(self, *args, **kwargs):
         self.args = args
-        self.kwargs = kwargs
+        self.kwargs = kwargs or Empty  # most have none, so share one.
+
+    def __hash__(self):
+        """
+        S-expressions hash by structure, so they can key a dict.
+        Like a tuple's, the hash fails if an argument is unhashable.
+        The hash is computed once, and kept.
+        >>> from operator import add
+        >>> {S(add, S.x, 1): 'spam'}[S(add, S.x, 1)]
+        'spam'
+        """
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+        # Hash the unhashed subtrees first, deepest first, so hashing
+        # each one only looks one level down, and deep trees don't recurse.
+        todo = []
+        seen = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            todo.append(node)
+            for x in chain(node.args, node.kwargs.values()):
+                if type(x) is SExpression and id(x) not in seen and not hasattr(x, '_hash'):
+                    seen.add(id(x))
+                    stack.append(x)
+        for node in reversed(todo):
+            node._hash = hash((SExpression, node.args, frozenset(node.kwargs.items())))
+        return self._hash
+
+    def __eq__(self, other):
+        """
+        S-expressions are equal if their arguments are the same type,
+        and equal. Unlike a tuple, ints don't equal floats here, and
+        Symbols don't equal strs, since they evaluate differently.
+        The same goes inside any tuple, list, or dict value in them.
+        >>> from operator import add
+        >>> S(add, S.x, 1) == S(add, S.x, 1)
+        True
+        >>> S(add, S.x, 1) == S(add, S.x, 1.0), S(add, S.x, 1) == S(add, 'x', 1)
+        (False, False)
+        >>> S(abs, (1,)) == S(abs, (1.0,))
+        False
+
+        Compared to any other Mapping, S-expressions work like one.
+        >>> S(add, sep=':') == {0: add, 'sep': ':'}
+        True
+        """
+        if self is other:
+            return True
+        if not isinstance(other, SExpression):
+            return Mapping.__eq__(self, other)
+        # Compare subtrees with a stack, so deep trees don't recurse.
+        pairs = [(self, other)]
+        while pairs:
+            a, b = pairs.pop()
+            if a is b:
+                continue
+            kind = type(a)
+            if kind is not type(b):
+                return False
+            if kind is SExpression:
+                try:
+                    if hash(a) != hash(b):
+                        return False
+                except TypeError:
+                    pass  # an argument is unhashable, so compare them all.
+                if len(a.args) != len(b.args) or len(a.kwargs) != len(b.kwargs):
+                    return False
+                for k in a.kwargs:
+                    if k not in b.kwargs:
+                        return False
+                pairs.extend(zip(a.args, b.args))
+                pairs.extend((v, b.kwargs[k]) for k, v in a.kwargs.items())
+            elif kind is tuple or kind is list:
+                if len(a) != len(b):
+                    return False
+                pairs.extend(zip(a, b))
+            elif kind is dict:
+                if len(a) != len(b) or any(k not in b for k in a):
+                    return False
+                pairs.extend((v, b[k]) for k, v in a.items())
+            elif not a == b:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    @staticmethod
+    def intern(element):
+        """
+        returns an S-expression equal to the element, sharing any
+        subtree with one already interned, so identical subtrees are
+        only kept once. The intern table only holds them weakly.
+        >>> from operator import add, mul
+        >>> spam = SExpression.intern(S(mul, S(add, S.x, 1), 2))
+        >>> eggs = SExpression.intern(S(add, S(add, S.x, 1), 2))
+        >>> spam[1] is eggs[1]
+        True
+        >>> SExpression.intern(S(mul, S(add, S.x, 1), 2)) is spam
+        True
+        """
+        if type(element) is not SExpression:
+            return element
+        # Intern the subtrees first, with a stack, so deep trees don't
+        # recurse. done maps the id of each subtree to its interned one.
+        done = {}
+
+        def interned(x):
+            return done[id(x)] if type(x) is SExpression else x
+
+        stack = [element]
+        while stack:
+            node = stack[-1]
+            pending = [x for x in chain(node.args, node.kwargs.values())
+                       if type(x) is SExpression and id(x) not in done]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            if id(node) in done:
+                continue  # a shared subtree, already interned.
+            args = tuple(map(interned, node.args))
+            kwargs = {k: interned(v) for k, v in node.kwargs.items()}
+            key = (tuple(map(_intern_key, args)),
+                   tuple((k, _intern_key(v)) for k, v in kwargs.items()))
+            try:
+                result = _interned[key]
+            except KeyError:
+                result = node
+                if not (all(map(lambda a, b: a is b, args, node.args))
+                        and all(kwargs[k] is v for k, v in node.kwargs.items())):
+                    result = S(*args, **kwargs)
+                _interned[key] = result
+            done[id(node)] = result
+        return done[id(element)]
+
+    def __reduce__(self):
+        """
+        S-expressions pickle as their arguments, so not with anything
+        cached on them, like a hash, which can differ between processes.
+        Functions in them pickle by qualified name, so the process that
+        loads them must be able to import them.
+        >>> import pickle
+        >>> from operator import add
+        >>> from drython.macro import If
+        >>> spam = _S(If, ~S.x, S(add, S.x, 1), -S.x, sep=S.y)
+        >>> pickle.loads(pickle.dumps(spam)) == spam
+        True
+        """
+        return _unpickle, (self.args, dict(self.kwargs))
 
     @staticmethod
     def from_mapping(mapping):
@@ -243,27 +1106,243 @@ class SExpression(Mapping, SEvaluable, SQuotable):
         args, kwargs = args_kwargs(mapping)
         return S(*args, **kwargs)
 
+    @staticmethod
+    def builder(*args, **kwargs):
+        """
+        returns an SBuilder, starting with the args and kwargs.
+        (S.builder would be a Symbol.)
+        >>> SExpression.builder(Print, 0).append(1).append(2).kw('sep', ':').freeze()()
+        0:1:2
+        """
+        return SBuilder(*args, **kwargs)
+
     def s_eval(self, scope):
         if not self:
             return self
         try:
             func = s_eval_in_scope(self.args[0], scope)
             if hasattr(func, '_macro_'):
-                lg.debug("expanding macro...\n%s\n", self)
-                element = func(*self.args[1:], **self.kwargs)
-                lg.debug("...sexpr headed by [%s] reports macro expanded to:\n%s\n", self[0], element)
-                return s_eval_in_scope(element, scope)
-            return func(
-                # generators CAN Unpack with *,
-                # but they mask TypeError messages due to Python bug!
-                # so we make it a tuple for better errors.
-                *tuple(s_eval_in_scope(a, scope) for a in self.args[1:]),
-                **{k: s_eval_in_scope(v, scope) for k, v in self.kwargs.items()})
+                return s_eval_in_scope(self.expansion(func), scope)
+            if _parallel_heads and func in parallel_args:
+                return self._s_eval_parallel(
+                    func, [(partial(s_eval_in_scope, e), type(e) is SExpression)
+                           for e in chain(self.args[1:], self.kwargs.values())])(scope)
+            if self.kwargs:
+                return func(
+                    # generators CAN Unpack with *,
+                    # but they mask TypeError messages due to Python bug!
+                    # so we make it a list for better errors.
+                    *_s_eval_all(self.args[1:], scope),
+                    **dict(zip(self.kwargs, _s_eval_all(self.kwargs.values(), scope))))
+            return func(*_s_eval_all(self.args[1:], scope))
         except BaseException as be:
-            Raise(SExpressionException('when evaluating\n' + repr(self)), From=be)
+            self._s_raise(be)
             # finally:
             #     pass
 
+    def expansion(self, func):
+        """
+        returns what the macro func expands this S-expression's arguments
+        to. The expansion is cached on this S-expression, so a macro
+        evaluated repeatedly is only expanded the first time.
+        >>> from drython.macro import If
+        >>> spam = S(If, S.x, 'yes', 'no')
+        >>> hits = expansion_counts['hits']
+        >>> [spam(x=x) for x in range(3)]
+        ['no', 'yes', 'yes']
+        >>> expansion_counts['hits'] - hits
+        2
+
+        Mark macros that depend on more than their arguments with
+        @nocache, to expand them every time.
+        >>> @macro
+        ... @nocache
+        ... def count(): return S(len, S.xs)
+        >>> misses = expansion_counts['misses']
+        >>> [S(count)(xs=[0] * x) for x in range(3)]
+        [0, 1, 2]
+        >>> expansion_counts['misses'] - misses
+        3
+        """
+        try:
+            head, element = self._expanded
+            if head is func:
+                expansion_counts['hits'] += 1
+                return element
+        except AttributeError:
+            pass
+        expansion_counts['misses'] += 1
+        lg.debug("expanding macro...\n%s\n", self)
+        element = func(*self.args[1:], **self.kwargs)
+        lg.debug("...sexpr headed by [%s] reports macro expanded to:\n%s\n", self[0], element)
+        if not hasattr(func, '_nocache_'):
+            self._expanded = func, element
+        return element
+
+    def s_eval_async(self, scope):
+        """
+        returns a coroutine that evaluates this S-expression in the scope,
+        awaiting awaitables. Needs Python 3.5 or later.
+        see help(drython.asynchronous.s_eval_async)
+        """
+        from drython.asynchronous import s_eval_async
+        return s_eval_async(self, scope)
+
+    def compile(self):
+        """
+        Compiles this S-expression into a function of a scope.
+        see help(drython.s_expression.compile)
+        >>> from operator import add
+        >>> spam = S(add,S.x,2).compile()
+        >>> spam(dict(x=40))
+        42
+        """
+        return compile(self)
+
+    def s_eval_many(self, scopes):
+        """
+        Evaluates this S-expression in each of the scopes, in order,
+        and yields the results as it goes. The S-expression is compiled
+        once, first, so macros expand only once, not once per scope.
+        see help(drython.s_expression.compile)
+        >>> from operator import add
+        >>> from drython.macro import If
+        >>> spam = S(If, S.x, S(add, S.x, S.y), 'none')
+        >>> list(spam.s_eval_many([dict(x=1, y=2), dict(x=0), dict(x=2, y=2)]))
+        [3, 'none', 4]
+        """
+        program = compile(self)
+        for scope in scopes:
+            yield program(scope)
+
+    def s_compile(self, env):
+        if not self:
+            return lambda scope: self
+        if not self.args:
+            return self.s_eval  # raises on evaluation, like s_eval would.
+        head = self.args[0]
+        if hasattr(head, '_macro_') and hasattr(head, '_nocache_'):
+            env.taint()
+            return self.s_eval  # so it expands on every evaluation.
+        if hasattr(head, '_macro_') and not s_evaluable(head):
+            try:
+                element = self.expansion(head)
+            except BaseException:
+                # let s_eval raise it, when and how it always has.
+                env.taint()
+                return self.s_eval
+            return self._s_compile_guard(compile(element, env))
+        if s_evaluable(head):
+            # might be a macro, and expand to anything.
+            env.taint()
+            head = head.s_compile(env)
+            args = tuple(compile(a, env) for a in self.args[1:])
+            kwargs = tuple((k, compile(v, env)) for k, v in self.kwargs.items())
+            return self._s_compile_dynamic(head, args, kwargs)
+        args = tuple(compile(a, env) for a in self.args[1:])
+        kwargs = tuple((k, compile(v, env)) for k, v in self.kwargs.items())
+        if head in parallel_args:
+            return self._s_compile_guard(self._s_eval_parallel(
+                head, [(c, type(e) is SExpression) for c, e in zip(
+                    args + tuple(v for _, v in kwargs),
+                    chain(self.args[1:], self.kwargs.values()))]))
+        return self._s_compile_call(head, args, kwargs)
+
+    def _s_eval_parallel(self, func, jobs):
+        # returns a function of the scope that evaluates the jobs with
+        # the func's executor, and calls the func with the results.
+        nargs = len(self.args) - 1
+
+        def call(scope):
+            values = _s_eval_parallel(jobs, scope, parallel_args.executor_for(func))
+            return func(*values[:nargs], **dict(zip(self.kwargs, values[nargs:])))
+
+        return call
+
+    def _s_compile_dynamic(self, head, args, kwargs):
+        # The head is only known at evaluation time, and might be a macro.
+        def dynamic(scope):
+            try:
+                func = head(scope)
+                if hasattr(func, '_macro_'):
+                    return s_eval_in_scope(self.expansion(func), scope)
+                return func(*[a(scope) for a in args], **{k: v(scope) for k, v in kwargs})
+            except BaseException as be:
+                self._s_raise(be)
+
+        return dynamic
+
+    def _s_compile_call(self, func, args, kwargs):
+        # Specialized for the common small arities.
+        # Each catches for itself, rather than paying for another frame.
+        if kwargs or len(args) > 3:
+            def call(scope):
+                try:
+                    return func(*[a(scope) for a in args], **{k: v(scope) for k, v in kwargs})
+                except BaseException as be:
+                    self._s_raise(be)
+        elif not args:
+            def call(scope):
+                try:
+                    return func()
+                except BaseException as be:
+                    self._s_raise(be)
+        elif len(args) == 1:
+            a, = args
+
+            def call(scope):
+                try:
+                    return func(a(scope))
+                except BaseException as be:
+                    self._s_raise(be)
+        elif len(args) == 2:
+            a, b = args
+
+            def call(scope):
+                try:
+                    return func(a(scope), b(scope))
+                except BaseException as be:
+                    self._s_raise(be)
+        else:
+            a, b, c = args
+
+            def call(scope):
+                try:
+                    return func(a(scope), b(scope), c(scope))
+                except BaseException as be:
+                    self._s_raise(be)
+        return call
+
+    def _s_compile_guard(self, compiled):
+        def guard(scope):
+            try:
+                return compiled(scope)
+            except BaseException as be:
+                self._s_raise(be)
+
+        return guard
+
+    def s_map(self, func):
+        """
+        >>> S(Print, 1, 2, sep=3).s_map(lambda x: x * 10 if x != Print else x)
+        S(<built-in function print>,
+          10,
+          20,
+          **{'sep': 30})
+        """
+        args = tuple(map(func, self.args))
+        kwargs = {k: func(v) for k, v in self.kwargs.items()}
+        if (all(map(lambda a, b: a is b, args, self.args))
+                and all(kwargs[k] is v for k, v in self.kwargs.items())):
+            return self  # keeps the expansion cache.
+        return S(*args, **kwargs)
+
+    def _s_raise(self, be):
+        # adds this S-expression as context to the exception being handled.
+        if isinstance(be, LabeledBreak):
+            raise  # control flow, not an error.
+        Raise(SExpressionException(_Evaluating(self)), From=be)
+
     # def __repr__(self):
     #     return "S(*"+repr(self.args)+", **"+repr(self.kwargs)+")"
     def __repr__(self):
@@ -317,6 +1396,91 @@ class SExpression(Mapping, SEvaluable, SQuotable):
         return kwar, S(*self.args, **cdr)
 
 
+class SBuilder(object):
+    """
+    Builds an S-expression an element at a time, in amortized constant
+    time for each, where cons, kwons, and concat would copy the whole
+    S-expression for every one. Make one with SExpression.builder().
+
+    freeze() returns the S-expression, without copying what's built,
+    so the builder is used up.
+    >>> spam = SExpression.builder(Print, 1)
+    >>> spam.extend([2, 3]).splice(S(4, sep='::'))
+    SBuilder(<built-in function print>, 1, 2, 3, 4, sep='::')
+    >>> len(spam)
+    6
+    >>> spam.freeze()()
+    1::2::3::4
+    >>> spam.append(5)
+    Traceback (most recent call last):
+      ...
+    TypeError: this SBuilder is frozen
+    """
+    __slots__ = 'args', 'kwargs'
+
+    def __init__(self, *args, **kwargs):
+        self.args = list(args)
+        self.kwargs = kwargs
+
+    def append(self, arg):
+        """adds the positional argument. Returns the builder."""
+        try:
+            self.args.append(arg)
+        except AttributeError:
+            self._frozen()
+        return self
+
+    def extend(self, args):
+        """adds the positional arguments. Returns the builder."""
+        try:
+            self.args.extend(args)
+        except AttributeError:
+            self._frozen()
+        return self
+
+    def kw(self, key, value):
+        """sets the keyword argument. Returns the builder."""
+        if self.kwargs is None:
+            self._frozen()
+        self.kwargs[key] = value
+        return self
+
+    def splice(self, data):
+        """
+        adds the args and kwargs of data, like concat. Returns the builder.
+        """
+        args, kwargs = args_kwargs(data)
+        self.extend(args)
+        self.kwargs.update(kwargs)
+        return self
+
+    def freeze(self):
+        """returns the S-expression built."""
+        if self.args is None:
+            self._frozen()
+        sexpr = SExpression(*self.args)
+        if self.kwargs:
+            sexpr.kwargs = self.kwargs
+        self.args = self.kwargs = None
+        return sexpr
+
+    @staticmethod
+    def _frozen():
+        raise TypeError('this SBuilder is frozen')
+
+    def __len__(self):
+        if self.args is None:
+            self._frozen()
+        return len(self.args) + len(self.kwargs)
+
+    def __repr__(self):
+        if self.args is None:
+            return 'SBuilder(<frozen>)'
+        return 'SBuilder({0})'.format(', '.join(
+            [repr(a) for a in self.args] +
+            ['{0}={1!r}'.format(k, v) for k, v in self.kwargs.items()]))
+
+
 def concat(*data):
     """
     Combines argument data, both positional and keyword, into an S-expression.
@@ -445,32 +1609,42 @@ def quasiquote(sexpr):
     #     # -> 'X ; (quote X)
     #     return S(quote, sexpr)
     lg.debug("quasiquoting:\n%s", sexpr)
-    return qq_expand(sexpr)
+    return qq_compile(sexpr)
 
 
+# quasiquote's expansion used to be qq_expand's chain of concats, one
+# per argument. quasiquote now uses qq_compile instead, but qq_expand
+# still gives the same chains, nested quasiquotes included. qq_step
+# builds them in a loop, rather than recursing once per argument.
 def qq_step(x):
     lg.debug("qq_step:\n%s", x)
     if not x:
         lg.debug("qq_step got %s, aborting.", x)
         return x
-    if x.args:  # not a tag. Step through list.
-        car, cdr = x.uncons()
-        lg.debug("qq_step unconsed (%s . %s)", car, cdr)
-        lg.debug("qq_step splicing")
-        splice = qq_splice(car)
-    elif x.kwargs:
-        kwar, cdr = x.unkwons()
-        lg.debug("qq_step unkwonsed (%s : %s)", kwar, cdr)
-        lg.debug("qq_step splicing")
-        splice = S(edict, kwar[0], qq_expand(kwar[1]))
-    lg.debug("qq_step expanding")
-    expand = qq_expand(cdr)
-    lg.debug("qq_step concatenating")
-    out = S(concat, splice, expand)
+    # A chain of concats, one per argument, as if each were unconsed in
+    # turn, but built from its end, so nothing is copied, and the Python
+    # stack doesn't grow with the number of arguments.
+    args = x.args
+    if _qq_dotted(args):
+        # the tail is a tag, as if unconsing had left it as a form.
+        out = qq_expand(S(*args[-2:], **x.kwargs))
+        args = args[:-2]
+    else:
+        out = S()
+        for k, v in x.kwargs.items():  # unkwons pops the last first.
+            out = S(concat, S(edict, k, qq_expand(v)), out)
+    for a in reversed(args):
+        out = S(concat, qq_splice(a), out)
     lg.debug("qq_step return:\n%s", out)
     return out
 
 
+def _qq_dotted(args):
+    # like `(a . ,b) in Lisp
+    return len(args) > 2 and (args[-2] == unquote or args[-2] == unquote_splice or
+                              args[-2] == quasiquote)
+
+
 def qq_expand(x):
     lg.debug("qq_expand:\n%s", x)
     if isinstance(x, SExpression):
@@ -526,7 +1700,7 @@ def qq_splice(x):
                 return data  # spliced. Return to concat directly.
             if tag == quasiquote:  # nested/next level
                 lg.debug("qq_splice found quasiquote...")
-                out = qq_splice(quasiquote(data))
+                out = qq_splice(qq_expand(data))
                 lg.debug("...qq_splice found quasiquote; return:\n%s", out)
                 return out
         lg.debug("qq_splice no tag in sexpr stepping...")
@@ -558,6 +1732,243 @@ def qq_splice(x):
 #         (else `'(,x))))
 # """
 
+class Template(object):
+    """
+    A quasiquote template, compiled to a function that builds it.
+
+    quasiquote expands a template to a call of one, with what it
+    unquotes and splices as the arguments, so an instantiation makes
+    each S-expression in the template once, and nothing in between.
+    >>> template = S(quasiquote, S(Print, 1, S(unquote, S.a), sep=':'))
+    >>> template.expansion(quasiquote)
+    S(Template((('const', <built-in function print>), ('const', 1), ('value', None)), (('sep', 'const', ':'),)),
+      S.a)
+    >>> template(a=2)
+    S(<built-in function print>,
+      1,
+      2,
+      **{'sep': ':'})
+
+    args are (kind, item) pairs, and kwargs (key, kind, item) triples.
+    Each kind is one of
+        'const': item itself.
+        'value': the next argument.
+        'splice': the next argument's args and kwargs, like concat.
+                  Not in kwargs.
+        'template': item, a Template, built from the next arguments.
+    """
+    __slots__ = 'args', 'kwargs', 'nslots', '_build'
+
+    def __init__(self, args, kwargs=()):
+        self.args = tuple(args)
+        self.kwargs = tuple(kwargs)
+        self.nslots = sum(item.nslots if kind == 'template' else kind != 'const'
+                          for kind, item in self.args + tuple(kw[1:] for kw in self.kwargs))
+        self._build = None
+
+    def __call__(self, *slots):
+        if self._build is None:
+            self._build = _template_builder(self)
+        return self._build(slots)
+
+    def __reduce__(self):
+        return Template, (self.args, self.kwargs)
+
+    def __eq__(self, other):
+        return (type(other) is Template and self.args == other.args and
+                self.kwargs == other.kwargs)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((Template, self.args, self.kwargs))
+
+    def __repr__(self):
+        return 'Template({0!r}, {1!r})'.format(self.args, self.kwargs)
+
+
+def _template_builder(template):
+    # Generates the builder's Python source, a statement per S-expression
+    # in the template, children first, and compiles it. The template is
+    # walked with an explicit stack, so deep ones neither recurse here,
+    # nor nest too deeply for Python's parser in the source.
+    constants = []
+    names = {}  # by id, so a head repeated in the template is one constant.
+    lines = []
+    slots = count()
+
+    def constant(value):
+        name = names.get(id(value))
+        if name is None:
+            name = names[id(value)] = '_k{0}'.format(len(constants))
+            constants.append(value)
+        return name
+
+    # each frame is [key, todo, args, kwargs], keyed by None for args.
+    stack = [[None, _template_todo(template), [], []]]
+    while stack:
+        frame = stack[-1]
+        for key, kind, item in frame[1]:
+            if kind == 'template':
+                stack.append([key, _template_todo(item), [], []])
+                break
+            code = constant(item) if kind == 'const' else '_s{0}'.format(next(slots))
+            _qq_add(frame, key, (kind, code))
+        else:
+            key, _, args, kwargs = stack.pop()
+            name = '_t{0}'.format(len(lines))
+            lines.append('{0} = {1}'.format(name, _template_statement(
+                args, ['{0}: {1}'.format(constant(k), code) for k, _, code in kwargs], lines)))
+            if stack:
+                _qq_add(stack[-1], key, ('value', name))
+    source = 'def _make(_k):\n'
+    if constants:
+        source += '    {0}, = _k\n'.format(', '.join('_k{0}'.format(i) for i in range(len(constants))))
+    # The slots come as one tuple, since before Python 3.7 a def can't
+    # have more than 255 parameters.
+    source += '    def build(_s):\n'
+    if template.nslots:
+        source += '        {0}, = _s\n'.format(
+            ', '.join('_s{0}'.format(i) for i in range(template.nslots)))
+    source += ''.join('        {0}\n'.format(line) for line in lines)
+    source += '        return {0}\n    return build\n'.format(name)
+    namespace = dict(_new=SExpression, _kw=_kw, _splice=_splice)
+    exec(source, namespace)
+    return namespace['_make'](constants)
+
+
+# Before Python 3.7, a call can't have more than this many arguments.
+_MAX_ARGS = 255
+
+
+def _template_todo(template):
+    return chain(((None,) + a for a in template.args), template.kwargs)
+
+
+def _template_statement(args, kwargs, lines):
+    # the expression that builds one S-expression, from its parts' code.
+    if not any(kind == 'splice' for kind, _ in args):
+        if len(args) > _MAX_ARGS:
+            sexpr = '_new(*({0},))'.format(', '.join(code for _, code in args))
+        else:
+            sexpr = '_new({0})'.format(', '.join(code for _, code in args))
+        if kwargs:
+            return '_kw({0}, {{{1}}})'.format(sexpr, ', '.join(kwargs))
+        return sexpr
+    spliced = '_w{0}'.format(len(lines))
+    lines.append('{0} = {{}}'.format(spliced))
+    runs = [[]]  # splices go between runs of single args.
+    for kind, code in args:
+        if kind == 'splice':
+            runs.extend(['_splice({0}, {1})'.format(spliced, code), []])
+        else:
+            runs[-1].append(code)
+    return '_kw(_new(*({0})), {1}, {{{2}}})'.format(' + '.join(
+        run if type(run) is str else '({0},)'.format(', '.join(run))
+        for run in runs if run), spliced, ', '.join(kwargs))
+
+
+def _kw(sexpr, *kwargs):
+    merged = {}
+    for d in kwargs:
+        merged.update(d)
+    if merged:
+        sexpr.kwargs = merged
+    return sexpr
+
+
+def _splice(spliced, data):
+    args, kwargs = args_kwargs(data)
+    spliced.update(kwargs)
+    return tuple(args)
+
+
+def qq_compile(x):
+    """
+    The quasiquote expansion of x, with Template builders. Like
+    qq_expand, but the expansion evaluates to the same S-expression
+    with one call per S-expression in the template.
+    >>> qq_compile(S(abs, S(unquote, S.x), S(unquote_splice, S.y)))
+    S(Template((('const', <built-in function abs>), ('value', None), ('splice', None)), ()),
+      S.x,
+      S.y)
+    """
+    if isinstance(x, SExpression):
+        if len(x.args) == 2:  # might be a tag
+            tag, data = x[0], x[1]
+            if tag == unquote:
+                return data
+            if tag == unquote_splice:
+                raise SExpressionException("Naked splice")
+            if tag == quasiquote:  # nested/next level
+                return qq_compile(qq_compile(data))
+        if not x:
+            return x
+        slots = []
+        return S(_qq_plan(x, slots), *slots)
+    # must be an atom. Quote it.
+    return S(quote, x)
+
+
+def _qq_plan(x, slots):
+    # Depth first, like the builder takes its slots, but with an explicit
+    # stack instead of Python's, so deep templates can't overflow it.
+    # Each frame is [key, todo, args, kwargs], keyed by None for args.
+    stack = [[None, _qq_todo(x), [], []]]
+    while True:
+        frame = stack[-1]
+        for key, element in frame[1]:
+            kind, item = _qq_element(element, slots, key is None)
+            if kind == 'template':
+                stack.append([key, _qq_todo(item), [], []])
+                break
+            _qq_add(frame, key, (kind, item))
+        else:
+            key, _, args, kwargs = stack.pop()
+            template = Template(args, kwargs)
+            if not stack:
+                return template
+            _qq_add(stack[-1], key, ('template', template))
+
+
+def _qq_todo(x):
+    args, kwargs = x.args, x.kwargs.items()
+    if _qq_dotted(args):
+        # the tail is a tag: spliced in, without any kwargs, like qq_step.
+        tag, data = args[-2:]
+        if tag == unquote_splice:
+            raise SExpressionException("Naked splice")
+        if tag == quasiquote:
+            data = qq_compile(qq_compile(data))
+        args, kwargs = args[:-2] + (S(unquote_splice, data),), ()
+    return iter([(None, a) for a in args] + list(kwargs))
+
+
+def _qq_add(frame, key, entry):
+    if key is None:
+        frame[2].append(entry)
+    else:
+        frame[3].append((key,) + entry)
+
+
+def _qq_element(x, slots, splicing):
+    while isinstance(x, SExpression) and len(x.args) == 2 and x[0] == quasiquote:
+        x = qq_compile(x[1])  # the next level's expansion is this one's template.
+    if not isinstance(x, SExpression):
+        return 'const', x
+    if len(x.args) == 2:
+        if x[0] == unquote:
+            slots.append(x[1])
+            return 'value', None
+        if x[0] == unquote_splice:
+            if not splicing:
+                raise SExpressionException("Naked splice")
+            slots.append(x[1])
+            return 'splice', None
+    return 'template', x  # for _qq_plan to plan.
+
+
 class unquote(object):
     r"""
     unquotes an element in a quasiquoted S-expression. Usually written as ~S...
@@ -697,6 +2108,7 @@ class Symbol(SEvaluable, SQuotable, str):
     >>> S.quux + S.norf
     S.quuxnorf
     """
+    __slots__ = ()
 
     def __repr__(self):
         """
@@ -719,6 +2131,9 @@ class Symbol(SEvaluable, SQuotable, str):
     def __add__(self, other):
         return Symbol(str.__add__(self,other))
 
+    def __reduce__(self):
+        return Symbol, (str(self),)
+
     def s_eval(self, scope=Empty):
         """ looks up itself in scope """
         try:
@@ -728,6 +2143,72 @@ class Symbol(SEvaluable, SQuotable, str):
                 'Symbol %s is not bound in the given scope' % repr(self)
             ), From=None)
 
+    def s_compile(self, env):
+        name = str(self)
+        depth, slot = env.address(name)
+        if slot is not None:
+            # A parameter is always bound, so this can't fail.
+            if depth == 0:
+                return lambda scope: scope.slots[slot]
+            if depth == 1:
+                return lambda scope: scope.parent.slots[slot]
+            depth = -1 - depth
+            return lambda scope: scope.display[depth].slots[slot]
+        if depth == 0:
+            def lookup(scope):
+                try:
+                    return scope[name]
+                except KeyError:
+                    self._unbound()
+        elif depth == 1:
+            def lookup(scope):
+                try:
+                    return scope.parent[name]
+                except KeyError:
+                    self._unbound()
+        elif depth < env.depth:
+            depth = -1 - depth
+
+            def lookup(scope):
+                try:
+                    return scope.display[depth][name]
+                except KeyError:
+                    self._unbound()
+        else:  # free in every enclosing Frame, so go right to the outermost scope.
+            depth = -depth
+
+            def lookup(scope):
+                try:
+                    return scope.display[depth].parent[name]
+                except KeyError:
+                    self._unbound()
+        return lookup
+
+    def _unbound(self):
+        Raise(SymbolError(
+            'Symbol %s is not bound in the given scope' % repr(self)
+        ), From=None)
+
+
+def _unpickle(args, kwargs):
+    sexpr = SExpression(*args)
+    sexpr.kwargs = kwargs or Empty  # not **kwargs, since keys needn't be strs.
+    return sexpr
+
+
+_interned = weakref.WeakValueDictionary()
+# Atoms that intern by value. Others intern by id, and so are kept
+# alive while it matters by the interned S-expression holding them.
+_atomic = frozenset([int, str, bytes, bool, type(None), Symbol])
+
+
+def _intern_key(element):
+    if type(element) in _atomic:
+        return type(element), element
+    if type(element) in (float, complex):
+        return type(element), repr(element)  # so -0.0 isn't 0.0
+    return id, id(element)  # interned S-expressions included.
+
 
 # This is just a stub so the IDE can find it.
 def gensym(prefix=''):
@@ -835,17 +2316,174 @@ _S = _private()
 del _private
 
 
-def flatten_sexpr(sexpr):
+class TreePath(object):
     """
-    recursively return all values in an S-expression as a list.
+    The keys from a walked element to one of its nodes, which works like
+    their tuple. Each is made in constant time from its parent's, so
+    walking a deep tree isn't quadratic. Compare to tuples, or make one.
+    >>> path = TreePath(TreePath(TreePath(), 1), 'k')
+    >>> path
+    (1, 'k')
+    >>> path == (1, 'k'), len(path), path[-1], tuple(path.parent)
+    (True, 2, 'k', (1,))
     """
-    res = []
-    for v in sexpr.values():
-        if isinstance(v, SExpression):
-            res.extend(flatten_sexpr(v))
+    __slots__ = 'parent', 'key', 'depth'
+
+    def __init__(self, parent=None, key=None):
+        self.parent = parent
+        self.key = key
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    def __iter__(self):
+        keys = []
+        path = self
+        while path.parent is not None:
+            keys.append(path.key)
+            path = path.parent
+        return reversed(keys)
+
+    def __len__(self):
+        return self.depth
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, TreePath):
+            other = tuple(other)
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+def walk(element, order='pre'):
+    """
+    Yields (path, node) for the element, and every node in it, depth
+    first. A path is a TreePath of the keys (ints for args, strs for
+    kwargs) from the element to the node. With order='pre', each S-expression
+    comes before its arguments. With order='post', it comes after.
+    >>> from operator import add
+    >>> for path, node in walk(S(add, S(abs, S.x), k=1)):
+    ...     print(path, type(node).__name__)
+    () SExpression
+    (0,) builtin_function_or_method
+    (1,) SExpression
+    (1, 0) builtin_function_or_method
+    (1, 1) Symbol
+    ('k',) int
+    >>> [path for path, _ in walk(S(add, S(abs, S.x), k=1), order='post')]
+    [(0,), (1, 0), (1, 1), (1,), ('k',), ()]
+
+    The walk is iterative, so the Python stack doesn't grow with
+    the depth of the tree, and it yields nodes as it goes.
+    """
+    if order not in ('pre', 'post'):
+        raise ValueError("order must be 'pre' or 'post', not {0!r}".format(order))
+    post = order == 'post'
+    root = TreePath()
+    if not post:
+        yield root, element
+    if not isinstance(element, SExpression):
+        if post:
+            yield root, element
+        return
+    # each frame is [path, node, items]
+    stack = [[root, element, _items(element)]]
+    while stack:
+        frame = stack[-1]
+        for key, child in frame[2]:
+            path = TreePath(frame[0], key)
+            if isinstance(child, SExpression):
+                if not post:
+                    yield path, child
+                stack.append([path, child, _items(child)])
+                break
+            yield path, child
+        else:
+            stack.pop()
+            if post:
+                yield frame[0], frame[1]
+
+
+def transform(element, func):
+    """
+    Returns the element, with func applied to every node, bottom up.
+    Each S-expression is passed to func with its arguments already
+    transformed. An S-expression is only rebuilt if func changed one of
+    its arguments, so unchanged subtrees are shared with the original.
+    >>> from operator import add, sub
+    >>> spam = S(add, S(abs, S.x), S(abs, 2))
+    >>> eggs = transform(spam, lambda node: sub if node is add else node)
+    >>> eggs
+    S(<built-in function sub>,
+      S(<built-in function abs>,
+        S.x),
+      S(<built-in function abs>,
+        2))
+    >>> eggs[1] is spam[1]
+    True
+
+    Like walk, it's iterative, so deep trees work too.
+    """
+    if not isinstance(element, SExpression):
+        return func(element)
+    # each frame is [node, items, transformed arguments, changed]
+    stack = [[element, _items(element), [], False]]
+    while True:
+        frame = stack[-1]
+        for _, child in frame[1]:
+            if isinstance(child, SExpression):
+                stack.append([child, _items(child), [], False])
+                break
+            new = func(child)
+            frame[2].append(new)
+            frame[3] = frame[3] or new is not child
         else:
-            res.append(v)
-    return res
+            old, _, values, changed = stack.pop()
+            node = old
+            if changed:
+                nargs = len(old.args)
+                node = SExpression(*values[:nargs])
+                if old.kwargs:
+                    node.kwargs = dict(zip(old.kwargs, values[nargs:]))
+            node = func(node)
+            if not stack:
+                return node
+            stack[-1][2].append(node)
+            stack[-1][3] = stack[-1][3] or node is not old
+
+
+def _items(sexpr):
+    if not sexpr.kwargs:
+        return enumerate(sexpr.args)  # most have none.
+    return chain(enumerate(sexpr.args), sexpr.kwargs.items())
+
+
+def flatten_sexpr(sexpr):
+    """
+    returns all the values in an S-expression, and in those nested in
+    it, as a list, in walk order.
+    >>> from operator import add
+    >>> flatten_sexpr(S(add, S(abs, S.x), k=1))
+    [<built-in function add>, <built-in function abs>, S.x, 1]
+
+    Any other Mapping is flattened from its values.
+    >>> flatten_sexpr({'a': S(abs, S.x)})
+    [<built-in function abs>, S.x]
+    """
+    roots = [sexpr] if isinstance(sexpr, SExpression) else sexpr.values()
+    return [node for root in roots for _, node in walk(root)
+            if not isinstance(node, SExpression)]
 
 
-__all__ = ['_S'] + [e for e in globals().keys() if not e.startswith('_')]  # if e not in _exclude_from__all__]
+# compile is left out so that import * doesn't shadow the builtin.
+__all__ = ['_S'] + [e for e in globals().keys()
+                    if not e.startswith('_')
+                    if e != 'compile']  # if e not in _exclude_from__all__]
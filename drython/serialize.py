@@ -0,0 +1,555 @@
+# Copyright 2016 Matthew Egan Odendahl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A compact binary format for S-expression programs.
+
+>>> from operator import add, mul
+>>> from drython.s_expression import S
+>>> spam = S(add, S(mul, S.x, 10), S(mul, S.x, S.x))
+>>> data = dumps(spam)
+>>> loads(data) == spam
+True
+>>> import pickle
+>>> len(data) < len(pickle.dumps(spam, 2))
+True
+
+A stream is a header, then any number of elements, until it ends.
+
+    stream  = MAGIC version element*
+    version = varint, currently 1
+    element = varint size, then that many bytes: a varint count of
+              runs, the runs, then the codes
+    run     = tag, varint count, then that many constants
+    codes   = width byte, 1, 2 or 4, varint count, then that many
+              unsigned ints of that width
+
+A varint is an unsigned integer, seven bits to a byte, least
+significant first, with the high bit set in every byte but the last.
+Fixed-size numbers are little-endian.
+
+A stream has a table of what it's loaded so far. It starts with None,
+False, and True. An element adds its new constants to it, run by run,
+then its new nodes. Everything else refers to the table by index, so
+a Symbol, head, or number is only written once per stream. So is a
+node that's in the tree more than once, as macro expansions often
+are, and it loads as one object.
+
+    tag name     the run's constants
+    0   int      int64s
+    1   big      as str, in decimal, for ints too big for an int64,
+                 and Python 2's longs
+    2   float    IEEE 754 doubles
+    3   complex  two doubles each, real then imaginary
+    4   str      uint32 end offsets, in characters, then a varint byte
+                 length, and the strs, all together, in UTF-8
+    5   bytes    as str, but offsets in bytes, and the bytes as they are
+    6   Symbol   as str
+    7   global   as str, each "module:qualified.name" of a function,
+                 class or other object importable by name
+
+Ints are int64s rather than zigzag varints, so a run of them unpacks
+in one struct call, where varints would take a Python loop per int.
+On CPython 3.9, for the 2000 small ints of bench_serialize's program,
+varints would save 12 kB of the 80 kB stream, but add about 2.4 ms to
+its 6.7 ms load. Pickle takes 449 kB and 14.5 ms. Ints outside int64
+go in a big run, so any int can be written.
+
+The codes are the new nodes, in batches, then the index of the element
+itself. The nodes in a batch are of one kind, with as many codes each,
+and only have nodes from batches before it in them. A batch is its
+kind, the index of a type if it's a reduce batch, how many nodes are in
+it, how many codes each has, then their codes, which are indexes, but
+for the first of an S with keywords.
+
+    kind name    each node's codes
+    0   S        its arguments
+    1   S        how many arguments it has, the arguments, then its
+                 keywords, as key, value pairs
+    2   tuple    its items
+    3   list     its items
+    4   dict     its keys and values, as key, value pairs
+    5   Quote    the quoted element
+    6   reduce   the arguments to call the batch's type with, for the
+                 types in reducible, e.g. nodes from macro expansion,
+                 like SIf. They reduce as for pickle, but loading only
+                 calls types in reducible.
+
+Other objects can't be written, so raise a TypeError.
+
+So loading unpacks each run, and the codes, with one struct call each,
+and builds the nodes a batch at a time. S-expressions without keywords,
+tuples, and lists take no Python code per node, and reduced nodes only
+take their type's own.
+
+Don't load streams from anyone you wouldn't take a program from. A
+stream can't call anything while loading but the reducible types, but
+it can import any module by name, and name anything in it, like
+os.system, as the head of an S-expression, which runs when the
+program does. The same goes for a ProgramCache's directory.
+"""
+
+# serialize depends on core, s_expression, and macro.
+
+from __future__ import absolute_import, division
+from collections import deque
+from io import BytesIO
+from itertools import chain, repeat, starmap
+import struct
+import sys
+
+from drython.core import Empty
+from drython.s_expression import SExpression, Symbol, Quote, Memo, Template, _import
+from drython.macro import SEval, ScopeGetter, SSetQ, SLambda, SLambda0, SLambda1, SLambda2
+from drython.macro import SLambdaA, SNonlocal, SIf
+
+if sys.version_info[0] == 2:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    from itertools import izip as zip, imap as map
+    # noinspection PyUnresolvedReferences
+    _text, _long = unicode, long
+else:  # pragma: no cover
+    _text, _long = str, int
+
+MAGIC = b'\x89DRS'
+VERSION = 1
+
+INT, BIG, FLOAT, COMPLEX, STR, BYTES, SYMBOL, GLOBAL = range(8)
+SEXPR, SEXPR_KW, TUPLE, LIST, DICT, QUOTE, REDUCE = range(7)
+
+# Types written with their __reduce__. Add others to write them too.
+reducible = {SEval, ScopeGetter, SSetQ, SLambda, SLambda0, SLambda1, SLambda2,
+             SLambdaA, SNonlocal, SIf, Memo, Template}
+
+# what every stream's table starts with.
+_SEED = (None, False, True)
+# constants the table keys by value. Others are keyed by id.
+_by_value = frozenset([int, _long, bool, type(None), str, _text, bytes, Symbol])
+_INT64 = -1 << 63, (1 << 63) - 1
+_WIDTHS = {1: 'B', 2: 'H', 4: 'I'}
+_byte = struct.Struct('<B')
+# Set a slot on each of many nodes, with no Python call per node.
+_consume = deque(maxlen=0).extend
+_set_args, _set_kwargs = SExpression.args.__set__, SExpression.kwargs.__set__
+
+
+def dumps(element):
+    """returns the element in a bytes stream."""
+    file = BytesIO()
+    Dumper(file).dump(element)
+    return file.getvalue()
+
+
+def dump(element, file):
+    """writes the element to the binary file, as a stream."""
+    Dumper(file).dump(element)
+
+
+def loads(data):
+    """returns the only element in the bytes stream."""
+    return _load_one(Loader(BytesIO(), data))
+
+
+def load(file):
+    """reads the only element in a stream from the binary file."""
+    return _load_one(Loader(file))
+
+
+def load_buffer(buffer):
+    """
+    returns the only element in a stream in the buffer, e.g. an mmap,
+    unpacking it from there, rather than from a copy.
+    """
+    return _load_one(Loader(BytesIO(), buffer))
+
+
+def _load_one(loader):
+    element = loader.load()
+    if not loader.at_end():
+        raise ValueError('more than one element in the stream')
+    return element
+
+
+class Dumper(object):
+    """
+    Writes elements to a binary file, as one stream, so they share its
+    table.
+    >>> from drython.s_expression import S
+    >>> from io import BytesIO
+    >>> file = BytesIO()
+    >>> dumper = Dumper(file)
+    >>> dumper.dump(S(abs, S.x))
+    >>> dumper.dump(S(abs, S.x))  # only the new node is written.
+    >>> _ = file.seek(0)
+    >>> list(Loader(file))
+    [S(<built-in function abs>,
+      S.x), S(<built-in function abs>,
+      S.x)]
+    """
+
+    def __init__(self, file):
+        self.file = file
+        # the stream's table, and the index of each thing in it, by
+        # _key. The table keeps what's keyed by id, so its id is.
+        self.table = list(_SEED)
+        self.index = {_key(x): i for i, x in enumerate(_SEED)}
+        file.write(MAGIC + _varint(VERSION))
+
+    def dump(self, element):
+        index = self.index
+        new = set()
+        runs = {}  # tag: [(constant, value to write)]
+        nodes = []  # (node, kind, type, children), in postorder
+        stack = [(element, None)]
+        while stack:
+            x, node = stack.pop()
+            if node is not None:
+                nodes.append(node)  # its children are done.
+                continue
+            key = _key(x)
+            if key in index or key in new:
+                continue
+            new.add(key)
+            node = _node(x)
+            if node is None:
+                tag, value = _constant(x)
+                runs.setdefault(tag, []).append((x, value))
+            else:
+                stack.append((x, node))
+                stack.extend((child, None) for child in reversed(node[3]))
+                if node[2] is not None:
+                    stack.append((node[2], None))
+
+        table = self.table
+        tags = sorted(runs)
+        for tag in tags:
+            for x, _ in runs[tag]:
+                index[_key(x)] = len(table)
+                table.append(x)
+        # Batch the nodes by kind and size, and by height, so no node is
+        # in a batch before one it has in it.
+        heights = {}
+        batches = {}
+        for node in nodes:
+            x, kind, func, children = node
+            height = heights[id(x)] = 1 + max(
+                [heights.get(id(child), 0) for child in children] or [0])
+            size = len(children) + (kind == SEXPR_KW)
+            batches.setdefault((height, kind, func, size), []).append(node)
+        codes = []
+        for key in sorted(batches, key=lambda key: key[:2]):
+            batch = batches[key]
+            codes.append(key[1])
+            if key[1] == REDUCE:
+                codes.append(index[_key(key[2])])
+            codes.append(len(batch))
+            codes.append(key[3])
+            for x, kind, _, children in batch:
+                if kind == SEXPR_KW:
+                    codes.append(len(x.args))
+                codes.extend(index[_key(child)] for child in children)
+            for x, _, _, _ in batch:
+                index[_key(x)] = len(table)
+                table.append(x)
+        codes.append(index[_key(element)])
+
+        out = _varint(len(tags))
+        for tag in tags:
+            values = [value for _, value in runs[tag]]
+            out.append(tag)
+            out += _varint(len(values))
+            out += _pack(tag, values)
+        width = 1 if max(codes) < 1 << 8 else 2 if max(codes) < 1 << 16 else 4
+        out.append(width)
+        out += _varint(len(codes))
+        out += struct.pack('<{0}{1}'.format(len(codes), _WIDTHS[width]), *codes)
+        self.file.write(_varint(len(out)) + out)
+
+
+def _key(x):
+    kind = type(x)
+    if kind in _by_value:
+        return kind, x
+    if kind is float or kind is complex:
+        return kind, repr(x)  # so -0.0 isn't 0.0
+    return id(x)
+
+
+def _node(x):
+    # returns the node, its kind, the type it reduces with, if any, and
+    # its children, or None if it's a constant.
+    kind = type(x)
+    if kind is SExpression:
+        if x.kwargs:
+            return x, SEXPR_KW, None, x.args + tuple(chain.from_iterable(x.kwargs.items()))
+        return x, SEXPR, None, x.args
+    if kind is tuple or kind is list:
+        return x, TUPLE if kind is tuple else LIST, None, x
+    if kind is dict:
+        return x, DICT, None, tuple(chain.from_iterable(x.items()))
+    if kind is Quote:
+        return x, QUOTE, None, (x.item,)
+    if kind in reducible:
+        func, args = x.__reduce__()[:2]
+        if func is not _import:  # else importable by name, so a global.
+            return x, REDUCE, func, tuple(args)
+    return None
+
+
+def _constant(x):
+    # returns the constant's run tag, and what to write for it.
+    kind = type(x)
+    if kind is int and _INT64[0] <= x <= _INT64[1]:
+        return INT, x
+    if kind is int or kind is _long:
+        return BIG, str(x)
+    if kind is float:
+        return FLOAT, x
+    if kind is complex:
+        return COMPLEX, x
+    if kind is _text:
+        return STR, x
+    if kind is bytes:
+        return BYTES, x
+    if kind is Symbol:
+        return SYMBOL, x if isinstance(x, _text) else x.decode('utf-8')
+    return GLOBAL, _qualified(x)
+
+
+def _qualified(obj):
+    if obj is Empty:
+        return 'drython.core:Empty'
+    if type(obj) in reducible:
+        module, name = obj.__reduce__()[1]
+    else:
+        owner = getattr(obj, '__objclass__', None)
+        module = getattr(obj, '__module__', None) or getattr(owner, '__module__', None)
+        name = getattr(obj, '__qualname__', None)
+        if name is None and hasattr(obj, '__name__'):  # Python 2
+            name = obj.__name__ if owner is None else owner.__name__ + '.' + obj.__name__
+    if not (module and name) or _import(module, name) is not obj:
+        raise TypeError("can't serialize {0!r}, which isn't importable by name"
+                        .format(obj))
+    return module + ':' + name
+
+
+def _pack(tag, values):
+    n = len(values)
+    if tag == INT:
+        return struct.pack('<{0}q'.format(n), *values)
+    if tag == FLOAT:
+        return struct.pack('<{0}d'.format(n), *values)
+    if tag == COMPLEX:
+        return struct.pack('<{0}d'.format(2 * n),
+                           *chain.from_iterable((c.real, c.imag) for c in values))
+    data = b''.join(values) if tag == BYTES else u''.join(values).encode('utf-8')
+    ends = []
+    end = 0
+    for value in values:
+        end += len(value)
+        ends.append(end)
+    return struct.pack('<{0}I'.format(n), *ends) + _varint(len(data)) + data
+
+
+class Loader(object):
+    """
+    Reads the elements of a stream from a binary file, as it goes.
+    Iterate over it for each element, to the end of the stream.
+    The stream starts in the buffer, if given, and goes on in the file.
+    """
+    CHUNK = 1 << 16
+
+    def __init__(self, file, buffer=None):
+        self.file = file
+        self.buffer = bytearray() if buffer is None else buffer
+        self.pos = 0
+        self.table = list(_SEED)
+        if self._read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a drython stream')
+        version = self._varint()
+        if version != VERSION:
+            raise ValueError('unsupported stream version {0}'.format(version))
+
+    def __iter__(self):
+        while not self.at_end():
+            yield self.load()
+
+    def at_end(self):
+        return self.pos == len(self.buffer) and not self._fill(1)
+
+    def load(self):
+        """reads the next element."""
+        size = self._varint()
+        if not self._fill(size):
+            raise EOFError('stream ended in an element')
+        start = self.pos
+        self.pos += size
+        try:
+            return self._element(start, self.pos)
+        except (IndexError, KeyError, struct.error):
+            raise ValueError('damaged element')
+
+    def _fill(self, n):
+        # makes sure the buffer has n more bytes, if the file does.
+        # Returns False if it doesn't.
+        while len(self.buffer) - self.pos < n:
+            more = self.file.read(max(self.CHUNK, n))
+            if not more:
+                return False
+            self.buffer = self.buffer[self.pos:] + more
+            self.pos = 0
+        return True
+
+    def _read(self, n):
+        if len(self.buffer) - self.pos < n and not self._fill(n):
+            raise EOFError('stream ended in an element')
+        start = self.pos
+        self.pos += n
+        return self.buffer[start:self.pos]
+
+    def _varint(self):
+        result = shift = 0
+        while True:
+            byte = bytearray(self._read(1))[0]
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def _element(self, pos, end):
+        buf, table = self.buffer, self.table
+        runs, pos = _varint_at(buf, pos)
+        for _ in range(runs):
+            tag, = _byte.unpack_from(buf, pos)
+            n, pos = _varint_at(buf, pos + 1)
+            pos = _unpack(tag, n, buf, pos, table)
+        width, = _byte.unpack_from(buf, pos)
+        n, pos = _varint_at(buf, pos + 1)
+        codes = struct.unpack_from('<{0}{1}'.format(n, _WIDTHS[width]), buf, pos)
+        if pos + n * width != end:
+            raise ValueError('damaged element')
+        return _build(codes, table)
+
+
+def _unpack(tag, n, buf, pos, table):
+    # adds the run's n constants, at pos in buf, to the table, and
+    # returns where the run ends.
+    if tag == INT or tag == FLOAT or tag == COMPLEX:
+        count = 2 * n if tag == COMPLEX else n
+        values = struct.unpack_from('<{0}{1}'.format(count, 'q' if tag == INT else 'd'),
+                                    buf, pos)
+        table.extend(map(complex, values[::2], values[1::2]) if tag == COMPLEX else values)
+        return pos + 8 * count
+    if not INT <= tag <= GLOBAL:
+        raise ValueError('unknown tag {0}'.format(tag))
+    ends = struct.unpack_from('<{0}I'.format(n), buf, pos)
+    size, pos = _varint_at(buf, pos + 4 * n)
+    data = bytes(buf[pos:pos + size])
+    if len(data) != size or ends[-1] > size:
+        raise ValueError('damaged element')
+    if tag != BYTES:
+        data = data.decode('utf-8')
+    values = map(data.__getitem__, map(slice, (0,) + ends[:-1], ends))
+    if tag == SYMBOL:
+        values = map(Symbol, values if _text is str else [v.encode('utf-8') for v in values])
+    elif tag == GLOBAL:
+        values = map(_global, values)
+    elif tag == BIG:
+        values = map(_long, values)
+    table.extend(values)
+    return pos + size
+
+
+def _build(codes, table):
+    # builds the nodes in the codes, adding them to the table, and
+    # returns the element the last code is the index of.
+    get = table.__getitem__
+    i, last = 0, len(codes) - 1
+    while i < last:
+        kind = codes[i]
+        if kind == REDUCE:
+            func = get(codes[i + 1])
+            i += 1
+        n, size = codes[i + 1:i + 3]
+        i += 3
+        span = codes[i:i + n * size]
+        i += n * size
+        # each node's items, if they're all indexes, else its codes.
+        items = iter(span if kind == SEXPR_KW else map(get, span))
+        items = zip(*[items] * size) if size else repeat((), n)
+        if kind == SEXPR:
+            nodes = list(map(SExpression.__new__, repeat(SExpression, n)))
+            _consume(map(_set_args, nodes, items))
+            _consume(map(_set_kwargs, nodes, repeat(Empty, n)))
+        elif kind == TUPLE:
+            nodes = items
+        elif kind == REDUCE:
+            # Only the reducible types are called, so a stream can't
+            # call anything else it names, like os.system.
+            if not (isinstance(func, type) and func in reducible):
+                raise ValueError("won't reduce with {0!r}, which isn't reducible"
+                                 .format(func))
+            nodes = starmap(func, items)
+        elif kind == SEXPR_KW:
+            nodes = map(_sexpr_kw, items, repeat(get, n))
+        elif kind == LIST:
+            nodes = map(list, items)
+        elif kind == DICT:
+            nodes = (dict(zip(item[::2], item[1::2])) for item in items)
+        elif kind == QUOTE:
+            nodes = (Quote(item) for item, in items)
+        else:
+            raise ValueError('unknown kind {0}'.format(kind))
+        table.extend(nodes)
+    if i != last:
+        raise ValueError('damaged element')
+    return get(codes[last])
+
+
+def _sexpr_kw(span, get):
+    items = list(map(get, span[1:]))
+    nargs = span[0]
+    sexpr = SExpression.__new__(SExpression)
+    sexpr.args = tuple(items[:nargs])
+    sexpr.kwargs = dict(zip(items[nargs::2], items[nargs + 1::2]))
+    return sexpr
+
+
+def _varint_at(buf, pos):
+    # the varint at pos in buf, and where it ends.
+    result = shift = 0
+    while True:
+        byte, = _byte.unpack_from(buf, pos)
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _global(qualified):
+    module, name = qualified.split(':')
+    obj = _import(module, name)
+    if obj is None:
+        raise ValueError("can't import {0}:{1}".format(module, name))
+    return obj
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
@@ -0,0 +1,45 @@
+"""
+Tests that need Python 3.5 or later, since async def is a SyntaxError
+before then. tests.py only imports them where they can run.
+"""
+import unittest  # pragma: no cover
+
+
+class TestAsynchronous(unittest.TestCase):  # pragma: no cover
+    def test_s_eval_async(self):
+        import asyncio
+        from operator import add, sub
+        from drython.s_expression import S, SExpressionException
+        from drython.macro import If, L1, let_n, let1, fn, setq
+        from drython.expression import entuple
+
+        async def later(x):
+            await asyncio.sleep(0)
+            return x
+
+        def run(coroutine):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(coroutine)
+            finally:
+                loop.close()
+
+        eq = self.assertEqual
+        for sexpr in (S(If, S(S.later, S.x), S(add, S.x, 1), S(sub, S.x, 1)),
+                      S(S(L1, S.a, S(add, S.a, S.x)), S(S.later, 5)),
+                      S(let_n, (S.a, 1, S.b, S(add, S.x, 1)),
+                        S(entuple, S.a, S.b)),
+                      S(dict, a=S(S.f, S.x), b=S(S.later, S.x)),
+                      # awaitables bound by let_n, or in a lambda's body.
+                      S(let_n, (S.a, S(S.later, 1), S.b, S(add, S.a, S(S.later, S.x))),
+                        S(entuple, S.a, S(S.later, S.b))),
+                      S(let1, S.a, S(S.later, S.x), S(sub, S(S.later, S.a), 1)),
+                      S(S(fn, [S.a], [S.b, S(S.later, 2)], None, None,
+                          S(setq, S.a, S(S.later, S(add, S.a, S.b))), S.a), S.x)):
+            for x in (0, 3):
+                scope = dict(x=x, later=later, f=later)
+                result = run(sexpr.s_eval_async(scope))
+                scope.update(f=lambda x: x, later=lambda x: x)
+                eq(result, sexpr.s_eval(scope))
+        with self.assertRaises(SExpressionException):
+            run(S(add, S(later, 1), 'a').s_eval_async({}))
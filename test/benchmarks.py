@@ -0,0 +1,251 @@
+"""
+Micro-benchmarks for the S-expression evaluator.
+Run from the repository root with
+
+    python test/benchmarks.py
+"""
+from __future__ import print_function  # pragma: no cover
+import sys  # pragma: no cover
+from timeit import repeat  # pragma: no cover
+
+
+def best(func, number=100000):  # pragma: no cover
+    """the fastest time for one call to func, in nanoseconds."""
+    return min(repeat(func, number=number, repeat=5)) / number * 1e9
+
+
+def bench_dispatch():  # pragma: no cover
+    """
+    s_eval_in_scope, per argument, against the hasattr and ABC
+    isinstance check it used to make for every element.
+    """
+    from drython.core import SEvaluable
+    from drython.s_expression import S, s_eval_in_scope
+
+    def uncached(element, scope):
+        if hasattr(element, '_s_evaluable_') and isinstance(element, SEvaluable):
+            return element.s_eval(scope)
+        return element
+
+    scope = dict(x=1)
+    print('s_eval_in_scope per argument (ns): uncached, cached')
+    for element in (42, 'spam', 1.5, None, S.x, S(abs, -1)):
+        print('{0:>12} {1:8.1f} {2:8.1f}'.format(
+            type(element).__name__,
+            best(lambda: uncached(element, scope)),
+            best(lambda: s_eval_in_scope(element, scope))))
+    print('SExpression.s_eval per argument (ns)')
+    for args in ((42,) * 20, (S.x,) * 20):
+        sexpr = S(max, *args)
+        print('{0:>12} {1:8.1f}'.format(
+            type(args[0]).__name__,
+            best(lambda: sexpr.s_eval(scope), 20000) / len(args)))
+
+
+def bench_memory():  # pragma: no cover
+    """
+    Bytes per node with __slots__, not counting the arguments nodes
+    share, against a class keeping the same args and kwargs in a
+    __dict__, as SExpression used to.
+    """
+    import tracemalloc
+    from operator import add
+    from drython.s_expression import S, Quote
+    from drython.macro import SIf
+
+    class Dicted(object):
+        def __init__(self, *args, **kwargs):
+            self.args = args
+            self.kwargs = kwargs
+
+    def per_node(make, number=10000):
+        nodes = [None] * number
+        tracemalloc.start()
+        for i in range(number):
+            nodes[i] = make()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / number
+
+    x = S.x
+    print('bytes per node')
+    for name, make in (('S(add, 1, S.x)', lambda: S(add, 1, x)),
+                       ('with __dict__', lambda: Dicted(add, 1, x)),
+                       ('Quote(1)', lambda: Quote(1)),
+                       ('SIf', lambda: SIf(x, 1, 2))):
+        print('{0:>16} {1:8.1f}'.format(name, per_node(make)))
+
+
+def bench_iterative():  # pragma: no cover
+    """
+    s_eval_iterative, per S-expression, against s_eval.
+    """
+    from operator import add, mul, sub
+    from drython.s_expression import S, s_eval_iterative
+
+    rule = S(add, S(mul, S.price, S.qty), S(sub, S(mul, S.x, 2), S(add, S.x, 1)))
+    tree = S.x
+    for i in range(100):  # 500 S-expressions, so setup per call is lost.
+        tree = S(add, S(mul, S.price, S.qty), S(sub, S(mul, tree, 2), S(add, S.x, 1)))
+    scope = dict(price=3, qty=4, x=5)
+    print('per S-expression (ns): s_eval, s_eval_iterative')
+    for name, element, size, n in [('rule', rule, 5, 20000), ('tree', tree, 500, 200)]:
+        print('{0:5} {1:8.0f} {2:8.0f}'.format(
+            name,
+            best(lambda: element.s_eval(scope), n) / size,
+            best(lambda: s_eval_iterative(element, scope), n) / size))
+
+
+def bench_many():  # pragma: no cover
+    """
+    One rule over many records: s_eval per record, against s_eval_many.
+    """
+    from operator import add, mul, gt
+    from drython.s_expression import S
+    from drython.macro import If, let1
+
+    rule = S(let1, S.t, S(mul, S.price, S.qty),
+             S(If, S(gt, S.t, 100), S(add, S.t, -10), S.t))
+    records = [dict(price=p, qty=q) for p in range(10) for q in range(100)]
+    print('per record (us): s_eval, s_eval_many')
+    print('{0:8.2f} {1:8.2f}'.format(
+        best(lambda: [rule.s_eval(r) for r in records], 10) / len(records) / 1e3,
+        best(lambda: list(rule.s_eval_many(records)), 10) / len(records) / 1e3))
+
+
+def bench_template():  # pragma: no cover
+    """
+    Instantiating a 20-argument quasiquote template: the concat chain
+    quasiquote used to expand to, against the Template builder it
+    expands to now.
+    """
+    from drython.s_expression import S, SExpression, Symbol, quote, unquote, concat, make_sexpr
+    from drython.s_expression import qq_compile
+
+    template = S(max, *[S(unquote, Symbol('a{0}'.format(i))) if i % 2 else i for i in range(20)])
+    scope = {'a{0}'.format(i): i for i in range(20)}
+    concat_chain = S()
+    for a in reversed(template.args):
+        concat_chain = S(concat, S(make_sexpr, a[1]) if isinstance(a, SExpression) else S(quote, S(a)),
+                         concat_chain)
+    builder = qq_compile(template)
+    print('20-argument template (us): concat chain, Template')
+    print('{0:8.2f} {1:8.2f}'.format(
+        best(lambda: concat_chain.s_eval(scope), 1000) / 1e3,
+        best(lambda: builder.s_eval(scope), 1000) / 1e3))
+
+
+def bench_builder():  # pragma: no cover
+    """
+    Building an S-expression an argument at a time: kwons, against
+    SExpression.builder().
+    """
+    from drython.s_expression import SExpression, kwons
+
+    def by_kwons(n):
+        sexpr = SExpression(max)
+        for i in range(n):
+            sexpr = kwons(i + 1, i, sexpr)
+        return sexpr
+
+    def by_builder(n):
+        builder = SExpression.builder(max)
+        for i in range(n):
+            builder.append(i)
+        return builder.freeze()
+
+    print('per argument (us): kwons, builder')
+    for n in (10, 100, 1000):
+        print('{0:>12} {1:8.2f} {2:8.2f}'.format(
+            n, best(lambda: by_kwons(n), 10) / n / 1e3, best(lambda: by_builder(n), 10) / n / 1e3))
+
+
+def bench_read():  # pragma: no cover
+    """Reading Lisp text, in megabytes per second."""
+    from io import StringIO
+    from operator import add
+    from drython.reader import iter_read
+
+    text = u''.join('(add {0} "s{0}" :k [x{0} 1.5]) ; {0}\n'.format(i) for i in range(20000))
+    print('reader (MB/s)')
+    print('{0:8.2f}'.format(
+        len(text) / best(lambda: sum(1 for _ in iter_read(StringIO(text), dict(add=add))), 1)
+        * 1e3))
+
+
+def bench_serialize():  # pragma: no cover
+    """
+    Loading a macro-expanded 2000-rule program: drython.serialize's
+    loads, against pickle's.
+    """
+    import pickle
+    from operator import add, gt, mul, sub
+    from drython.s_expression import S
+    from drython.macro import If, macroexpand_all
+    from drython.serialize import dumps, loads
+
+    program = macroexpand_all(S(list, *[
+        S(If, S(gt, S.price, i), S(mul, S.qty, S(add, i, 0.5)), S(sub, S.x, i))
+        for i in range(2000)]))
+    data, pickled = dumps(program), pickle.dumps(program, 2)
+    print('2000-rule program load (ms), and size (kB): serialize, pickle')
+    print('{0:8.2f} {1:8.2f} {2:8.1f} {3:8.1f}'.format(
+        best(lambda: loads(data), 20) / 1e6,
+        best(lambda: pickle.loads(pickled), 20) / 1e6,
+        len(data) / 1e3, len(pickled) / 1e3))
+
+
+def bench_parallel():  # pragma: no cover
+    """
+    A parallel_args head, with ten arguments that each sleep 0.1
+    seconds, against the second they'd take evaluated one after another.
+    """
+    from time import sleep, time
+    from drython.s_expression import S, parallel_args
+
+    def gather(*results):
+        return results
+
+    parallel_args(gather)
+    try:
+        sexpr = S(gather, *[S(sleep, 0.1) for _ in range(10)])
+        start = time()
+        sexpr()
+        print('ten 0.1s sleeps (s): parallel_args')
+        print('{0:8.2f}'.format(time() - start))
+    finally:
+        del parallel_args[gather]
+
+
+def bench_async():  # pragma: no cover
+    """
+    s_eval_async, with ten arguments that each sleep 0.1 seconds, against
+    the second they'd take evaluated one after another.
+    """
+    import asyncio
+    from time import time
+    from drython.s_expression import S
+    from drython.asynchronous import s_eval_async
+
+    sexpr = S(max, *[S(asyncio.sleep, 0.1, i) for i in range(10)])
+    loop = asyncio.new_event_loop()
+    start = time()
+    loop.run_until_complete(s_eval_async(sexpr, {}))
+    loop.close()
+    print('ten 0.1s sleeps (s): s_eval_async')
+    print('{0:8.2f}'.format(time() - start))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    bench_dispatch()
+    if sys.version_info >= (3, 4):
+        bench_memory()  # tracemalloc is new in 3.4.
+    bench_iterative()
+    bench_many()
+    bench_template()
+    bench_builder()
+    bench_read()
+    bench_serialize()
+    bench_parallel()
+    if sys.version_info >= (3, 5):
+        bench_async()
@@ -24,8 +24,12 @@ gc.collect()
 print(enumerate())
 """
 from __future__ import print_function  # pragma: no cover
+import sys  # pragma: no cover
 import unittest  # pragma: no cover
 
+if sys.version_info >= (3, 5):  # pragma: no cover
+    from async_tests import TestAsynchronous
+
 
 class TestStatement(unittest.TestCase):  # pragma: no cover
     def test_pass(self):
@@ -67,6 +71,803 @@ class TestStatement(unittest.TestCase):  # pragma: no cover
            dict(xs='abc', x0='a', x12=['b', 'c']))
 
 
+class TestSExpression(unittest.TestCase):  # pragma: no cover
+    def test_python2_import(self):
+        # setup.py still lists 2.7, so check the modules import there.
+        import os
+        import subprocess
+        python2 = os.environ.get('PYTHON2', 'python2.7')
+        try:
+            subprocess.check_call([python2, '-c', 'pass'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('no working {0} to check with'.format(python2))
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.check_call(
+            [python2, '-c', 'import drython.s_expression, drython.macro, drython.bytecode,'
+                            ' drython.optimize, drython.serialize, drython.cache, drython.reader'],
+            env=dict(os.environ, PYTHONPATH=root), cwd=root)
+
+    def test_compile(self):
+        from operator import add, mul, sub
+        from drython.s_expression import S, compile
+        from drython.macro import If, L1, let_n, setq, L0
+        from drython.expression import entuple
+        eq = self.assertEqual
+        for sexpr in (S(add, S(mul, S.x, 10), 2),
+                      S(If, S.x, S(add, S.x, 1), S(sub, S.x, 1)),
+                      S(S(L1, S.a, S(add, S.a, S.x)), 5),
+                      S(let_n, (S.a, 1, S.b, S(add, S.x, 1)),
+                        S(entuple, S.a, S.b)),
+                      S(S(L0, S(setq, S.q, 4), S.q)),
+                      S(S.f, S.x)):
+            compiled = compile(sexpr)
+            for x in (0, 3):
+                eq(sexpr.s_eval(dict(x=x, f=abs)), compiled(dict(x=x, f=abs)))
+
+    def test_compile_raises(self):
+        from operator import add
+        from drython.s_expression import S, SExpressionException, SymbolError
+        sexpr = S(add, S(add, S.x, 1), S.y)
+        for evaluate in (sexpr.s_eval, sexpr.compile()):
+            with self.assertRaises(SExpressionException) as cm:
+                evaluate(dict(x=1))
+            self.assertIsInstance(cm.exception.__cause__, SymbolError)
+            with self.assertRaises(SExpressionException) as cm:
+                evaluate(dict(x='1', y=2))
+            self.assertIsInstance(cm.exception.__cause__, SExpressionException)
+
+    def test_pycompile_raises(self):
+        # pycompile gives only the whole tree's context, once, however
+        # deep the error is. (s_eval gives the chain to the failing node.)
+        from operator import add, truediv
+        from drython.s_expression import S, SExpressionException
+        from drython.bytecode import pycompile
+
+        def contexts(evaluate, scope):
+            with self.assertRaises(SExpressionException) as cm:
+                evaluate(scope)
+            found, cause = [], cm.exception
+            while isinstance(cause, SExpressionException):
+                found.append(cause.args[0].element)
+                cause = cause.__cause__
+            self.assertIsInstance(cause, ZeroDivisionError)
+            return found
+
+        sexpr = S(add, 1, S(truediv, 1, S.x))
+        self.assertEqual(contexts(sexpr.s_eval, dict(x=0)), [sexpr, sexpr[2]])
+        self.assertEqual(contexts(pycompile(sexpr), dict(x=0)), [sexpr])
+        # compiled as a closure, which gives the same context itself.
+        sexpr = S(S.f, 1)
+        self.assertEqual(contexts(pycompile(sexpr), dict(f=lambda x: x / 0)), [sexpr])
+
+    def test_compile_lexical_addressing(self):
+        from drython.s_expression import S, compile
+        from drython.macro import L0, L1, setq, Nonlocal
+        from drython.expression import entuple
+        eq = self.assertEqual
+        for sexpr in (
+                # setq shadows x only after it runs.
+                S(S(L1, S.a, S(S(L1, S.b, S(entuple, S.x, S(setq, S.x, 5),
+                                            S.x, S.a)), 1)), 2),
+                # nonlocal writes to the parameter of the enclosing lambda.
+                S(S(L1, S.a, S(S(L0, S(Nonlocal, S.a), S(setq, S.a, 9))),
+                    S.a), 1),
+                # nonlocal binds a new name in the enclosing lambda.
+                S(S(L1, S.a, S(S(L0, S(Nonlocal, S.x), S(setq, S.x, 9))),
+                    S.x), 1)):
+            eq(sexpr.s_eval(dict(x=0)), compile(sexpr)(dict(x=0)))
+
+    def test_compile_nested_setq(self):
+        # a setq deep in nested fns recompiles each body once, not once
+        # per enclosing body's recompile, which doubled with each level.
+        import time
+        from drython.s_expression import S, compile
+        from drython.macro import fn, setq
+        from drython.expression import entuple
+        sexpr = S.x
+        for i in range(16):
+            sexpr = S(S(fn, [S.x], [], None, None,
+                        S(entuple, S.y, S(setq, S.y, 1), sexpr)), i)
+        start = time.time()
+        compiled = compile(sexpr)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(compiled(dict(x=0, y=5)), sexpr.s_eval(dict(x=0, y=5)))
+
+    def test_s_eval_iterative(self):
+        from operator import add, sub
+        from drython.s_expression import S, SExpressionException, s_eval_iterative
+        from drython.macro import If, L1, s_eval
+        eq = self.assertEqual
+        for sexpr in (S(add, S(add, S.x, 1), S.x),
+                      S(If, S.x, S(add, S.x, 1), S(sub, S.x, 1)),
+                      S(S(L1, S.a, S(add, S.a, S.x)), 5),
+                      S(s_eval, -S(add, S.x, 1)),
+                      S(S.f, S.x, **{'2': S.x}),
+                      S()):
+            for x in (0, 3):
+                scope = dict(x=x, f=lambda *a, **kw: (a, kw))
+                eq(sexpr.s_eval(scope), s_eval_iterative(sexpr, scope))
+
+        # errors get the same context s_eval gives them.
+        def context(evaluate, sexpr):
+            try:
+                evaluate(sexpr)
+            except SExpressionException as e:
+                chain = []
+                while isinstance(e, SExpressionException):
+                    chain.append(str(e))
+                    e = e.__cause__
+                return chain, type(e)
+        sexpr = S(add, 1, S(If, S.x, S(sub, S.x, k=1), 0))
+        eq(context(lambda e: e.s_eval(dict(x=1)), sexpr),
+           context(lambda e: s_eval_iterative(e, dict(x=1)), sexpr))
+        # an If ladder is as deep as it is long.
+        sexpr = 'none'
+        for i in range(50000):
+            sexpr = S(If, S(add, S.x, -i), sexpr, i)
+        eq(s_eval_iterative(sexpr, dict(x=49990)), 49990)
+
+    def test_intern(self):
+        import gc
+        from operator import add
+        from drython.s_expression import S, SExpression, _interned
+        spam = SExpression.intern(S(add, S(add, S.x, 1.0), S(add, S.x, 1)))
+        self.assertIsNot(spam[1], spam[2])  # 1.0 is not 1
+        self.assertIs(SExpression.intern(S(add, S.x, 1)), spam[2])
+        self.assertEqual(hash(spam), hash(S(add, S(add, S.x, 1.0), S(add, S.x, 1))))
+        size = len(_interned)
+        del spam
+        gc.collect()
+        self.assertEqual(len(_interned), size - 3)
+
+    def test_s_evals_bounded(self):
+        # the per-type s_eval cache doesn't keep every class alive.
+        from drython.s_expression import S, s_eval_in_scope, _s_evals, _S_EVALS_MAX
+        for i in range(2 * _S_EVALS_MAX):
+            spam = type('Spam{0}'.format(i), (object,), {})()
+            self.assertEqual(s_eval_in_scope(S(id, spam), {}), id(spam))
+        self.assertLessEqual(len(_s_evals), _S_EVALS_MAX)
+
+    def test_deep(self):
+        # hashing, comparing and interning use a stack, not recursion.
+        from operator import add
+        from drython.s_expression import S, SExpression
+
+        def deep(last):
+            spam = S.x
+            for _ in range(20000):
+                spam = S(add, spam, 1)
+            return S(add, spam, last)
+
+        spam, eggs = deep(1), deep(1)
+        self.assertEqual(hash(spam), hash(eggs))
+        self.assertEqual(spam, eggs)
+        self.assertNotEqual(spam, deep(1.0))
+        self.assertNotEqual(S(add, (1, [2])), S(add, (1, [2.0])))
+        self.assertNotEqual(S(add, {'a': 1}), S(add, {'a': 1.0}))
+        self.assertEqual(S(add, (1, [2], {'a': S.x})), S(add, (1, [2], {'a': S.x})))
+        self.assertIs(SExpression.intern(spam), SExpression.intern(eggs))
+
+    def test_s_eval_many(self):
+        from operator import add
+        from drython.s_expression import S
+        from drython.macro import If, let_n
+        sexpr = S(let_n, (S.a, S(add, S.x, 1)),
+                  S(If, S.a, S(add, S.a, S.x), S.x))
+        scopes = [dict(x=x) for x in range(-2, 3)]
+        self.assertEqual(list(sexpr.s_eval_many(iter(scopes))),
+                         [sexpr.s_eval(scope) for scope in scopes])
+
+    def test_parallel_args(self):
+        import threading
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            self.skipTest('needs concurrent.futures')
+        from operator import add
+        from drython.s_expression import S, SExpressionException, SymbolError
+        from drython.s_expression import parallel_args, compile
+        from drython.bytecode import pycompile
+        threads = set()
+
+        def where(x):
+            threads.add(threading.current_thread())
+            return x
+
+        with ThreadPoolExecutor(1) as pool:
+            # nested in a task of a full pool, so must not wait on it.
+            @parallel_args(executor=pool)
+            def both(a, b, c=0):
+                return a, b, c
+
+            try:
+                sexpr = S(both, S(both, S(where, S.x), 2), S(add, S.x, 1), c=S(where, 3))
+                for evaluate in (sexpr.s_eval, compile(sexpr), pycompile(sexpr)):
+                    self.assertEqual(evaluate(dict(x=1)), (((1, 2, 0), 2, 3)))
+                    with self.assertRaises(SExpressionException) as cm:
+                        evaluate(dict())
+                    cause = cm.exception
+                    while isinstance(cause, SExpressionException):
+                        cause = cause.__cause__
+                    self.assertIsInstance(cause, SymbolError)
+                self.assertNotIn(threading.current_thread(), threads)
+            finally:
+                del parallel_args[both]
+
+    def test_memo(self):
+        from drython.s_expression import S, memo, pure, compile
+        calls = []
+
+        @pure(memo=3)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertIn(square, pure)
+        sexpr = S(square, S.x)
+        for evaluate in (sexpr.s_eval, compile(sexpr)):
+            for x in (1, 2, 1, 3, 1):
+                self.assertEqual(evaluate(dict(x=x)), x * x)
+        self.assertEqual(calls, [1, 2, 3])
+        square(4)  # evicts 2, the least recently used.
+        square(2)
+        self.assertEqual(calls, [1, 2, 3, 4, 2])
+        self.assertEqual((square.hits, square.misses, square.evictions), (7, 5, 2))
+        self.assertEqual(memo(len, 1)(S.x), 1)
+
+    def test_builder(self):
+        from drython.s_expression import S, SExpression, SBuilder
+        from drython.expression import entuple
+
+        builder = SExpression.builder(entuple)
+        self.assertIsInstance(builder, SBuilder)
+        for i in range(10000):
+            builder.append(i)
+        builder.kw('spam', 1).splice({0: 'a', 'eggs': 2}).splice(S(b=3)).extend('cd')
+        self.assertEqual(len(builder), 1 + 10000 + 3 + 3)
+        sexpr = builder.freeze()
+        self.assertEqual(sexpr, S(entuple, *(list(range(10000)) + ['a', 'c', 'd']),
+                                  spam=1, eggs=2, b=3))
+        self.assertEqual(SExpression.builder().freeze(), S())
+        self.assertEqual(SExpression.builder(1, k=2).freeze(), S(1, k=2))
+        for use in (lambda: builder.append(1), lambda: builder.extend([1]),
+                    lambda: builder.kw('k', 1), lambda: builder.splice(S(1)),
+                    builder.freeze, lambda: len(builder)):
+            with self.assertRaises(TypeError):
+                use()
+        self.assertEqual(sexpr.args[-1], 'd')
+
+    def test_walk(self):
+        from operator import add, sub
+        from drython.s_expression import S, SExpression, Symbol, walk, transform, flatten_sexpr
+
+        spam = S(add, S(abs, S.x, k=S(sub, 1, 2)), S(), 3, j=S(abs, 4))
+        pre = list(walk(spam))
+        post = list(walk(spam, order='post'))
+        self.assertEqual(sorted(pre, key=repr), sorted(post, key=repr))
+        self.assertEqual([path for path, _ in pre],
+                         [(), (0,), (1,), (1, 0), (1, 1), (1, 'k'), (1, 'k', 0), (1, 'k', 1),
+                          (1, 'k', 2), (2,), (3,), ('j',), ('j', 0), ('j', 1)])
+        for path, node in pre:
+            found = spam
+            for key in path:
+                found = found[key]
+            self.assertIs(found, node)
+        self.assertEqual(post[-1], ((), spam))
+        self.assertEqual(list(walk(42)), [((), 42)])
+        self.assertEqual(list(walk(42, order='post')), [((), 42)])
+        with self.assertRaises(ValueError):
+            list(walk(spam, order='in'))
+        self.assertEqual(flatten_sexpr(spam), [add, abs, S.x, sub, 1, 2, 3, abs, 4])
+        # other Mappings flatten from their values, as they always have.
+        self.assertEqual(flatten_sexpr({'a': S(abs, S.x)}), [abs, S.x])
+        self.assertEqual(flatten_sexpr({'a': 1}), [1])
+
+        # only changed spines are rebuilt.
+        swapped = transform(spam, lambda node: sub if node is add else
+                            add if node is sub else node)
+        self.assertEqual(swapped, S(sub, S(abs, S.x, k=S(add, 1, 2)), S(), 3, j=S(abs, 4)))
+        self.assertIs(swapped['j'], spam['j'])
+        self.assertIs(swapped[2], spam[2])
+        self.assertIsNot(swapped[1], spam[1])
+        self.assertIs(transform(spam, lambda node: node), spam)
+        self.assertEqual(transform(S(abs, 1), lambda node: node + 1 if type(node) is int else node),
+                         S(abs, 2))
+        self.assertEqual(transform(1, lambda node: node + 1), 2)
+        # func sees S-expressions after their arguments.
+        self.assertEqual(transform(S(add, S(add, 1, 2), 3),
+                                   lambda node: node() if isinstance(node, SExpression) else node), 6)
+
+        deep = S.x
+        for i in range(20000):
+            deep = S(abs, deep)
+        self.assertEqual(sum(1 for _ in walk(deep, order='post')), 40001)
+        self.assertEqual(flatten_sexpr(deep)[-1], S.x)
+        negated = transform(deep, lambda node: -1 if type(node) is Symbol else node)
+        self.assertEqual(flatten_sexpr(negated)[-1], -1)
+        wide = S(*range(100000))
+        self.assertEqual(flatten_sexpr(wide), list(range(100000)))
+
+    def test_template(self):
+        import pickle
+        from drython.s_expression import S, SExpressionException
+        from drython.s_expression import quote, quasiquote, unquote, unquote_splice
+        from drython.s_expression import qq_compile, qq_expand, concat, make_sexpr
+        from drython.expression import entuple
+
+        scope = dict(a=1, b=S(2, 3, k=4), c=(5, 6), d=S.spam)
+        nested = qq_compile(S(entuple, S(unquote, S.a)))[0]
+        templates = [
+            (S(entuple, 1, S(unquote, S.a), S(unquote_splice, S.b), 7, k=S(unquote, S.a)),
+             S(entuple, 1, 1, 2, 3, 7, k=1)),
+            (S(entuple, S(unquote_splice, S.c), S(unquote_splice, S.b), k=S(unquote, S.d)),
+             S(entuple, 5, 6, 2, 3, k=S.spam)),
+            (S(entuple, S(S(unquote, S.a), S(S(unquote_splice, S.c)), j=S()), k=S(quote, 1)),
+             S(entuple, S(1, S(5, 6), j=S()), k=S(quote, 1))),
+            (S(entuple, S(quasiquote, S(entuple, S(unquote, S(unquote, S.a))))),
+             S(entuple, S(nested, 1))),
+            (S(S(unquote_splice, S.c)), S(5, 6)),
+            (S(k=S(unquote, S.a)), S(k=1)),
+            (S(), S()),
+            (S(unquote, S.a), 1),
+            (42, 42),
+        ]
+        deep = S(unquote, S.a)
+        expected = 1
+        for i in range(100):
+            deep = S(entuple, deep, S(unquote, S.a), k=i)
+            expected = S(entuple, expected, 1, k=i)
+        templates.append((deep, expected))
+        for template, expected in templates:
+            compiled = qq_compile(template)
+            self.assertEqual(compiled.s_eval(scope), expected)
+            self.assertEqual(S(quasiquote, template).s_eval(scope), expected)
+            self.assertEqual(pickle.loads(pickle.dumps(compiled)).s_eval(scope), expected)
+        # qq_expand still expands to a chain of concats.
+        for template, expected in templates[:3]:
+            self.assertIs(qq_expand(template)[0], concat)
+            self.assertEqual(qq_expand(template).s_eval(scope), expected)
+
+        # A nested quasiquote expands to the same plain concat chains, all
+        # the way down, with no Template in them.
+        def chain(*parts):
+            out = S()
+            for part in reversed(parts):
+                out = S(concat, part, out)
+            return out
+
+        def q(*args):
+            return S(quote, S(*args))
+
+        self.assertEqual(
+            qq_expand(S(1, S(quasiquote, S(S.f)))),
+            chain(q(1), S(make_sexpr, chain(
+                q(concat),
+                S(make_sexpr, chain(q(quote), S(make_sexpr, chain(q(S.f))))),
+                S(make_sexpr, S())))))
+
+        # wide and deep templates expand without recursing along them,
+        # and build without one argument per slot (255 before Python 3.7).
+        wide = S(entuple, *[S(unquote, S.a)] * 5000)
+        self.assertEqual(S(quasiquote, wide).s_eval(scope), S(entuple, *[1] * 5000))
+        for _ in range(5000):
+            deep = S(entuple, deep)
+        built = S(quasiquote, deep).s_eval(scope)
+        for _ in range(5000):
+            built = built[1]
+        self.assertEqual(built[2], 1)
+
+        # each instance is new.
+        template = S(quasiquote, S(entuple, S(entuple, 1)))
+        self.assertIsNot(template.s_eval({}), template.s_eval({}))
+        self.assertIsNot(template.s_eval({})[1], template.s_eval({})[1])
+        with self.assertRaises(SExpressionException):
+            S(quasiquote, S(entuple, k=S(unquote_splice, S.c))).s_eval(scope)
+
+
+class TestMacro(unittest.TestCase):  # pragma: no cover
+    def test_macroexpand_all(self):
+        from operator import add, sub
+        from drython.s_expression import S, SExpression, macro
+        from drython.macro import macroexpand_all, If, L1, let_n, fn, setq, L0
+        from drython.expression import entuple
+
+        @macro
+        def twice(x):
+            return S(add, x, x)
+
+        def heads(element):
+            found = []
+
+            def visit(e):
+                if isinstance(e, SExpression) and e.args:
+                    found.append(e.args[0])
+                if hasattr(e, 's_map'):
+                    e.s_map(visit)
+                return e
+
+            visit(element)
+            return found
+
+        eq = self.assertEqual
+        for sexpr in (S(If, S.x, S(add, S.x, 1), S(sub, S.x, 1)),
+                      S(S(L1, S.a, S(If, S.a, S(S.twice, S.a), S.x)), 5),
+                      S(let_n, (S.a, 1, S.b, S(add, S.x, 1)),
+                        S(entuple, S.a, S.b)),
+                      S(S(fn, [S.a], [S.b, S(S.twice, S.x)], None, None,
+                          S(entuple, S.a, S.b)), 1),
+                      S(S(L0, S(setq, S.q, S(S.twice, 4)), S.q))):
+            expanded = macroexpand_all(sexpr, dict(twice=twice))
+            self.assertFalse([h for h in heads(expanded) if hasattr(h, '_macro_')])
+            for x in (0, 3):
+                eq(sexpr.s_eval(dict(x=x, twice=twice)),
+                   expanded.s_eval(dict(x=x, twice=twice)))
+
+    def test_macroexpand_all_runtime_macro(self):
+        from operator import getitem, is_
+        from drython.s_expression import S
+        from drython.macro import macroexpand_all, defmac, If
+        from drython.statement import do
+
+        # head_is_if isn't bound until the program runs, so its argument
+        # must reach it as written, not expanded to an SIf.
+        program = S(do,
+                    S(defmac, S.head_is_if, [S.form], [], None, None,
+                      S(is_, S(getitem, S(getattr, S.form, 'args'), 0), If)),
+                    S(S.head_is_if, S(If, S.x, 1, 0)))
+        self.assertIs(program.s_eval({}), True)
+        self.assertIs(macroexpand_all(program).s_eval({}), True)
+
+
+class TestOptimize(unittest.TestCase):  # pragma: no cover
+    def test_fold_constants(self):
+        from operator import add, mul, sub
+        from drython.s_expression import S, quote, s_eval_in_scope
+        from drython.expression import entuple
+        from drython.macro import If, L1
+        from drython.optimize import fold_constants
+        eq = self.assertEqual
+        for sexpr, removed in (
+                (S(add, S(mul, 4, 10), 2), 2),
+                (S(If, S(sub, 1, 1), S.x, S(add, S.x, S(mul, 2, 3))), 2),
+                (S(S(L1, S.a, S(add, S.a, S(add, 1, 1))), S(mul, S.x, 2)), 1),
+                (S(entuple, S(quote, S(add, 1, 1)), S(quote, S(add, 2, 2))), 0)):
+            folded, count = fold_constants(sexpr)
+            eq(count, removed)
+            for x in (0, 3):
+                eq(sexpr.s_eval(dict(x=x)), s_eval_in_scope(folded, dict(x=x)))
+
+    def test_eliminate_common(self):
+        from operator import add, mul, getitem
+        from drython.s_expression import S, s_eval_in_scope
+        from drython.expression import entuple
+        from drython.macro import If, L1, fn, setq, L0
+        from drython.optimize import eliminate_common
+        eq = self.assertEqual
+        xk = S(getitem, S.d, S.x)
+        for sexpr, count in (
+                (S(entuple, S(add, xk, 1), S(add, xk, 1), xk), 2),
+                (S(If, S.x, S(mul, xk, 2), S(add, xk, 1)), 0),
+                (S(If, xk, S(mul, xk, 2), S(add, xk, 1)), 1),
+                (S(S(L1, S.a, S(mul, S(add, S.a, 1), S(add, S.a, 1))), xk), 1),
+                (S(S(fn, [S.a], [S.b, S(add, S.x, 1)], None, None,
+                     S(entuple, S.a, S.b)), S(add, S.x, 1)), 1),
+                (S(S(L0, S(setq, S.x, 0), S(entuple, xk, xk))), 0),
+                # f could be a macro, expanding to a setq.
+                (S(entuple, S(S.f, xk), S(S.f, xk)), 0)):
+            optimized, shared = eliminate_common(sexpr)
+            eq(shared, count)
+            for x in (0, 1):
+                scope = dict(x=x, d=[5, 6], f=abs)
+                eq(sexpr.s_eval(scope), s_eval_in_scope(optimized, scope))
+
+
+class TestColumnar(unittest.TestCase):  # pragma: no cover
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs numpy')
+
+    def test_s_eval_columnar(self):
+        import numpy as np
+        from operator import add, mul, lt, not_
+        from drython.s_expression import S, SExpressionException
+        from drython.macro import If, cond
+        from drython.columnar import s_eval_columnar, ColumnarError
+        columns = dict(x=np.arange(-3, 4), y=np.arange(7) * 2.5)
+        rows = [dict(x=int(x), y=float(y)) for x, y in zip(columns['x'], columns['y'])]
+        for sexpr in (S(add, S(mul, S.x, 10), S.y),
+                      S(If, S(lt, S.x, 0), S(mul, S.x, -1), S.y),
+                      S(abs, S(not_, S.x))):
+            self.assertEqual(list(s_eval_columnar(sexpr, columns)),
+                             [sexpr.s_eval(row) for row in rows])
+        self.assertEqual(
+            list(s_eval_columnar(S(cond, S(lt, S.x, -1), 'a', S(not_, S.x), 'b', Else='c'),
+                                 columns)),
+            list('aacbccc'))
+        self.assertRaises(ColumnarError, s_eval_columnar, S(S.f, S.x), dict(columns, f=len))
+        self.assertRaises(ColumnarError, s_eval_columnar, S(If, S.x, S.y), columns)
+        self.assertRaises(SExpressionException, s_eval_columnar, S(add, S.x, S.z), columns)
+
+
+class TestParallel(unittest.TestCase):  # pragma: no cover
+    def test_pickle(self):
+        import pickle
+        from operator import add
+        from drython.s_expression import S, _S, Symbol, Quote, memo
+        from drython.macro import If
+        from drython.core import Empty
+        spam = memo(add)
+        spam(1, 2)
+        for element in (S.x, Symbol('not an identifier'), S(If, S.x, -S.y),
+                        _S(add, ~S.x, +S.y), S**{0: add, 1: 2, 'sep': S.z}):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                loaded = pickle.loads(pickle.dumps(element, protocol))
+                self.assertIs(type(loaded), type(element))
+                self.assertEqual(loaded, element)
+        self.assertIs(pickle.loads(pickle.dumps(Empty)), Empty)
+        self.assertEqual(pickle.loads(pickle.dumps(Quote(S.x))).item, S.x)
+        loaded = pickle.loads(pickle.dumps(spam))
+        self.assertEqual((loaded.func, loaded.maxsize, len(loaded.cache)), (add, 128, 0))
+
+    def test_s_eval_many(self):
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            self.skipTest('needs concurrent.futures')
+        from operator import add, truediv
+        from drython.s_expression import S, SExpressionException
+        from drython.macro import If, let_n
+        from drython.parallel import s_eval_many, submit
+        sexpr = S(let_n, (S.a, S(add, S.x, 1)),
+                  S(If, S.a, S(truediv, S.x, S.a), S.x))
+        scopes = [dict(x=x) for x in range(-3, 10)]
+        with ProcessPoolExecutor(2) as pool:
+            self.assertEqual(list(s_eval_many(sexpr, scopes, pool, chunksize=3)),
+                             [sexpr.s_eval(scope) for scope in scopes])
+            with self.assertRaises(SExpressionException):
+                list(s_eval_many(S(truediv, 1, S.x), scopes, pool))
+            self.assertEqual(submit(pool, sexpr, dict(x=3)).result(), 0.75)
+
+
+class TestSerialize(unittest.TestCase):  # pragma: no cover
+    def test_round_trip(self):
+        from io import BytesIO
+        from operator import add
+        from drython.s_expression import S, _S, Quote, memo
+        from drython.macro import If, let_n
+        from drython.core import Empty
+        from drython.serialize import dumps, loads, Dumper, Loader
+        elements = [None, True, False, 0, 1, -1, 63, -64, 2 ** 70, -2 ** 70, 1.5,
+                    float('inf'), 2j, '', 'spam', u'\u00e9\u4e2d', b'\x00\xff',
+                    (), (1, (2,)), [1, [S.x]], {'a': 1, 2: S.y}, Empty, str.upper,
+                    S(), S(add, S.x, 1), S(If, S.x, -S.y, S(print, 1, sep=S.x)),
+                    _S(add, ~S.x, +S.y), S(let_n, (S.a, 1), S.a)]
+        for element in elements:
+            self.assertEqual(loads(dumps(element)), element)
+            self.assertIs(type(loads(dumps(element))), type(element))
+        self.assertEqual(loads(dumps(Quote(S.x))).item, S.x)
+
+        # ints past int64 go in a big run, even beside ones that don't.
+        edges = [2 ** 63 - 1, 2 ** 63, 2 ** 64, -2 ** 63, -2 ** 63 - 1, 10 ** 30]
+        self.assertEqual(loads(dumps(S(max, *edges))), S(max, *edges))
+        for i in edges:
+            self.assertEqual(loads(dumps(i)), i)
+
+        # a memo importable by name loads as that one, cache and all.
+        import sys
+        import types
+        module = sys.modules['memo_spam'] = types.ModuleType('memo_spam')
+
+        def spam(x):
+            return x
+        spam.__module__, spam.__qualname__ = 'memo_spam', 'spam'
+        module.spam = memo(spam)
+        try:
+            self.assertIs(loads(dumps(S(module.spam, 1)))[0], module.spam)
+        finally:
+            del sys.modules['memo_spam']
+
+        class Small(Loader):
+            CHUNK = 3
+
+        file = BytesIO()
+        dumper = Dumper(file)
+        for element in elements:
+            dumper.dump(element)
+        file.seek(0)
+        self.assertEqual(list(Small(file)), elements)
+
+    def test_template(self):
+        from drython.s_expression import S, qq_compile, unquote, unquote_splice
+        from drython.expression import entuple
+        from drython.serialize import dumps, loads
+        compiled = qq_compile(
+            S(entuple, 1, S(unquote, S.a), S(unquote_splice, S.b), k=S(unquote, S.a)))
+        self.assertEqual(loads(dumps(compiled)).s_eval(dict(a=1, b=S(2, 3))),
+                         S(entuple, 1, 1, 2, 3, k=1))
+
+    def test_errors(self):
+        from drython.s_expression import S
+        from drython.serialize import dumps, loads
+        self.assertRaises(TypeError, dumps, S(lambda: 1))
+        self.assertRaises(TypeError, dumps, S(abs, object()))
+        data = dumps(S(abs, S.x))
+        self.assertRaises(EOFError, loads, data[:-1])
+        self.assertRaises(ValueError, loads, data + data[5:])
+        self.assertRaises(ValueError, loads, data[:4] + b'\x03' + data[5:])
+        self.assertRaises(ValueError, loads, b'spam')
+        data = bytearray(data)
+        data[-1] = 200  # the element's index, past the end of the table.
+        self.assertRaises(ValueError, loads, data)
+        # only reducible types are called while loading.
+        from drython.macro import SIf
+        from drython.serialize import REDUCE
+        for func in (abs, dict):
+            # the codes are a batch of one SIf to reduce, then one of
+            # the tuple (func, SIf), then its index. Reduce with func.
+            data = bytearray(dumps((func, SIf(1, 2, 3))))
+            self.assertEqual(data[-13], REDUCE)
+            data[-12] = data[-3]
+            self.assertRaises(ValueError, loads, data)
+
+
+class TestCache(unittest.TestCase):  # pragma: no cover
+    def test_program_cache(self):
+        import os
+        import shutil
+        import tempfile
+        from operator import add
+        from drython.s_expression import S, macro
+        from drython.macro import If, L0, L1, let_n, fn, setq, Nonlocal, macroexpand_all
+        from drython.expression import entuple
+        from drython.serialize import dumps, loads
+        from drython.cache import ProgramCache
+
+        @macro
+        def twice(x):
+            return S(add, x, x)
+
+        directory = tempfile.mkdtemp()
+        try:
+            programs = (S(If, S.x, S(add, S.x, 1), 0),
+                        S(let_n, (S.a, 1, S.b, S(add, S.x, 1)), S(entuple, S.a, S.b)),
+                        S(S(fn, [S.a], [S.b, 2], S.c, S.d, S(entuple, S.a, S.b, S.c, S.d)),
+                          S.x, 3, 4, e=5),
+                        S(S(L1, S.a, S(S(L0, S(Nonlocal, S.a), S(setq, S.a, 9))), S.a), 1))
+            for cache in (ProgramCache(directory), ProgramCache(directory)):
+                for sexpr in programs:
+                    for x in (0, 3):
+                        self.assertEqual(cache.compile(sexpr)(dict(x=x)), sexpr.s_eval(dict(x=x)))
+            self.assertEqual((cache.hits, cache.misses), (8, 0))
+            self.assertEqual(len(os.listdir(directory)), len(programs))
+
+            # expansions share nodes, like the trees they were loaded from.
+            sexpr = macroexpand_all(S(If, S.x, S.x, S.x))
+            loaded = loads(dumps(S(entuple, sexpr, sexpr)))
+            self.assertIs(loaded[1], loaded[2])
+
+            # a macro that can't be imported by name can't be hashed.
+            sexpr = S(S.twice, S.x)
+            cache.compile(sexpr, dict(twice=twice))
+            self.assertEqual(cache.compile(sexpr, dict(twice=twice))(dict(x=2)), 4)
+            self.assertEqual((cache.misses, cache.uncached), (2, 2))
+
+            # a damaged file is made again.
+            path = cache.path(programs[0])
+            with open(path, 'wb') as file:
+                file.write(b'spam')
+            self.assertEqual(cache.compile(programs[0])(dict(x=1)), 2)
+            self.assertEqual(cache.compile(programs[0])(dict(x=1)), 2)
+            self.assertEqual((cache.hits, cache.misses), (9, 3))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_program_cache_edited_macro(self):
+        # an importable macro serializes by name, but editing it still misses.
+        import importlib
+        import os
+        import shutil
+        import tempfile
+        from drython.s_expression import S
+        from drython.cache import ProgramCache
+        source = ('from operator import {0}\n'
+                  'from drython.s_expression import S, macro\n'
+                  '@macro\n'
+                  'def twice(x):\n'
+                  '    return S({0}, x, {1})\n')
+        directory = tempfile.mkdtemp()
+        sys.path.insert(0, directory)
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True  # so no stale .pyc is imported.
+        try:
+            def define(*args):
+                with open(os.path.join(directory, 'cache_spam.py'), 'w') as file:
+                    file.write(source.format(*args))
+                sys.modules.pop('cache_spam', None)
+                return importlib.import_module('cache_spam').twice
+
+            cache = ProgramCache(os.path.join(directory, 'cache'))
+            twice = define('add', 'x')
+            self.assertEqual(cache.compile(S(twice, S.x))(dict(x=3)), 6)
+            self.assertEqual(cache.compile(S(twice, S.x))(dict(x=3)), 6)
+            self.assertEqual((cache.hits, cache.misses, cache.uncached), (1, 1, 0))
+            twice = define('mul', 2)
+            self.assertEqual(cache.compile(S(twice, S.x))(dict(x=5)), 10)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+            sys.path.remove(directory)
+            sys.modules.pop('cache_spam', None)
+            shutil.rmtree(directory)
+
+
+class TestReader(unittest.TestCase):  # pragma: no cover
+    def test_read(self):
+        from io import StringIO
+        from operator import add
+        from drython.s_expression import S, SExpression, Symbol
+        from drython.s_expression import quote, quasiquote, unquote, unquote_splice
+        from drython.reader import read, iter_read, ReaderError
+        import drython.reader as reader
+        import operator
+
+        namespace = dict(add=add, operator=operator)
+        self.assertEqual(
+            read('(add x -1.5 :spam "a\\"b" :eggs [1 True None])', namespace),
+            S(add, S.x, -1.5, spam='a"b', eggs=(1, True, None)))
+        self.assertEqual(read('(operator.mul 2 y)', namespace), S(operator.mul, 2, S.y))
+        self.assertEqual(read('(f - -x +)'), S(S.f, Symbol('-'), Symbol('-x'), Symbol('+')))
+        # numbers read the same on every Python, so only decimal digits.
+        self.assertEqual(read('[42 +7 -.5 5. 1e3 -1.5E-3 0123]'),
+                         (42, 7, -0.5, 5.0, 1000.0, -0.0015, 123))
+        for text in ('-inf', '+nan', '1_0', '1e', '0x10', '1.2.3'):
+            self.assertEqual(read(text), Symbol(text))
+        self.assertEqual(read("'x `(f ~a ~@b)"), S(quote, S.x))
+        self.assertEqual(list(iter_read("'x `(f ~a ~@b)"))[1],
+                         S(quasiquote, S(S.f, S(unquote, S.a), S(unquote_splice, S.b))))
+        self.assertEqual(read('()'), SExpression())
+
+        # forms and tokens split across chunks read the same.
+        text = u''.join('(add {0} "s{0}" :k [x{0}]) ; {0}\n'.format(i) for i in range(500))
+        whole = list(iter_read(text, namespace))
+        chunk = reader.CHUNK
+        try:
+            for reader.CHUNK in (1, 2, 7, 64):
+                self.assertEqual(list(iter_read(StringIO(text), namespace)), whole)
+        finally:
+            reader.CHUNK = chunk
+        self.assertEqual(len(whole), 500)
+        self.assertEqual(whole[42], S(add, 42, 's42', k=(S.x42,)))
+
+        # each form is yielded before the rest is read.
+        class Lines(object):
+            def __init__(self):
+                self.reads = 0
+
+            def read(self, n):
+                self.reads += 1
+                return '(f {0}) '.format(self.reads) if self.reads < 100 else ''
+
+        lines = Lines()
+        forms = iter_read(lines)
+        self.assertEqual(next(forms), S(S.f, 1))
+        self.assertLess(lines.reads, 3)
+
+        # strings can go over lines, escapes or not.
+        self.assertEqual(read('"a\\tb\nc"'), 'a\tb\nc')
+        self.assertEqual(read('"a\nb"'), 'a\nb')
+
+        for bad in ('(f x', '(f x]', ')', '[:k 1]', '(f :k)', '(f :k :j 1)', '"spam', 'x)',
+                    '"\\x4"', '(operator.nope 1)'):
+            with self.assertRaises(ReaderError):
+                list(iter_read(bad, namespace))
+        with self.assertRaises(ReaderError):
+            read(' ; nothing')
+
+
 if __name__ == '__main__':  # pragma: no cover
     print('in test main')
 
@@ -85,11 +886,21 @@ if __name__ == '__main__':  # pragma: no cover
     doctest.testmod(m=drython)
 
     from drython import core, statement, expression, stack, combinator, \
-        s_expression, macro
+        s_expression, macro, bytecode, optimize, columnar, serialize, cache, reader
 
     for m in (
-    core, statement, expression, stack, combinator, s_expression):
+    core, statement, expression, stack, combinator, s_expression, bytecode,
+    optimize, columnar, serialize, cache, reader):
         doctest.testmod(m=m)
+    try:
+        from drython import parallel
+    except ImportError:  # 2.7 has no concurrent.futures.
+        pass
+    else:
+        doctest.testmod(m=parallel)
+    if sys.version_info >= (3, 5):
+        from drython import asynchronous
+        doctest.testmod(m=asynchronous)
     try:
         pass
         unittest.main()